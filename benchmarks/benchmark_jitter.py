@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark for the jitter correction pipeline on synthetic atomic lattices with known line jitter.
+
+Jitter.dejitter_full_image is run with instrumentation, which records the time and peak memory allocation of each
+stage. The accuracy is measured by comparing the x-offsets with the jitter that was put into the image. Results are
+written to a JSON file, which can be passed to --compare in a later run to find regressions.
+
+Example:
+    python benchmarks/benchmark_jitter.py --sizes 512 2048 --output results.json
+    python benchmarks/benchmark_jitter.py --sizes 512 2048 --compare results.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import scipy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from jitter_utils import correct_jitter
+from jitter_utils import instrumentation
+from jitter_utils import kernels
+
+
+def make_lattice(size, spacing, jitter, atom_sigma=None, counts=200, seed=0):
+    # Square lattice of Gaussian atoms where every row is shifted along x by a random amount (the line jitter).
+    # Returns the image with Poisson noise and the shift of each row in pixels.
+    rng = np.random.RandomState(seed)
+    if atom_sigma is None:
+        atom_sigma = spacing / 6
+    shifts = rng.normal(0, jitter, size)
+    y = np.arange(size, dtype=np.float32)
+    x = np.arange(size, dtype=np.float32)
+    y_distance = np.abs((y + spacing/2) % spacing - spacing/2)
+    x_distance = np.abs((x[np.newaxis, :] - shifts[:, np.newaxis].astype(np.float32) + spacing/2) % spacing -
+                        spacing/2)
+    image = (np.exp(-y_distance**2 / (2*atom_sigma**2))[:, np.newaxis] *
+             np.exp(-x_distance**2 / (2*atom_sigma**2)))
+    image = rng.poisson(image * counts + counts/20).astype(np.uint16)
+    return image, shifts
+
+def line_jitter(row_shifts):
+    # Line-to-line jitter: the standard deviation of the shift between neighbouring rows (divided by sqrt(2))
+    return float(np.std(np.diff(row_shifts)) / np.sqrt(2))
+
+def run_case(size, spacing, sigma, box_size, jitter, noise_tolerance, seed, fused=False):
+    image, shifts = make_lattice(size, spacing, jitter, seed=seed)
+    # The stage records of Jitter itself, so that the benchmark times exactly the code that dejitter_full_image runs
+    # (e.g. the fused x-correction with the Numba kernels). Messages are not printed.
+    stage_records = instrumentation.Instrumentation(callback=lambda event_type, name, value: None, track_memory=True)
+    jitter_object = correct_jitter.Jitter(instrumentation=stage_records)
+    jitter_object.image = image
+    jitter_object.blur_radius = sigma
+    jitter_object.noise_tolerance = noise_tolerance
+    start = time.perf_counter()
+    coordinate_offsets = jitter_object.dejitter_full_image(box_size=box_size, fused=fused)
+    corrected = jitter_object.apply_correction(coordinate_offsets)
+    total_time = time.perf_counter() - start
+    stages = dict((name, dict(record)) for name, record in stage_records.stages.items())
+    maxima = jitter_object.maxima
+    mask = correct_jitter.make_box_mask(box_size)
+    # Same boxes as in dejitter_full_image, only used for the accuracy (outside of the timing)
+    corners = correct_jitter.box_corners(maxima, image.shape, int(box_size/2))
+    owners = correct_jitter.box_owner_map(image.shape, corners, mask.shape, overlap=jitter_object.overlap)
+    # The x-offset of a pixel should be the shift of the row it is taken from. Only pixels inside of a box are
+    # corrected and the correction keeps the mean position in each box, so compare the line-to-line jitter.
+    covered = owners >= 0
+    source_rows = np.clip(np.arange(size)[:, np.newaxis] + coordinate_offsets[0], 0, size - 1)
+    residuals = np.where(covered, shifts[source_rows] - coordinate_offsets[1], np.nan)
+    covered_rows = np.sum(covered, axis=1) > 0
+    row_residuals = np.nanmedian(residuals[covered_rows], axis=1)
+    return {'size': size, 'spacing': spacing, 'sigma': sigma, 'box_size': box_size, 'jitter': jitter,
+            'noise_tolerance': noise_tolerance, 'fused': fused, 'number_maxima': len(maxima),
+            'covered_fraction': float(np.mean(covered)),
+            'line_jitter_before': line_jitter(shifts[covered_rows]),
+            'line_jitter_after': line_jitter(row_residuals),
+            'score_before': float(correct_jitter.jitter_score(image)),
+            'score_after': float(correct_jitter.jitter_score(corrected)),
+            'total_time': total_time,
+            'kernel_backend': jitter_object.kernel_backend,
+            'counters': dict(stage_records.counters),
+            'stages': stages}
+
+def compare(results, previous_results, tolerance):
+    # Prints all stages that got slower by more than "tolerance" (as a factor) compared to a previous run
+    def key(result):
+        return (tuple(result[name] for name in ('size', 'spacing', 'sigma', 'box_size', 'jitter', 'noise_tolerance')) +
+                (result.get('fused', False),))
+    previous = dict((key(result), result) for result in previous_results)
+    regressions = 0
+    for result in results:
+        if key(result) not in previous:
+            continue
+        for name, stage in result['stages'].items():
+            previous_stage = previous[key(result)]['stages'].get(name)
+            if previous_stage is not None and stage['time'] > tolerance * previous_stage['time']:
+                regressions += 1
+                print('Regression in {} for {}: {:.3f} s (before {:.3f} s)'.format(name, key(result), stage['time'],
+                                                                                  previous_stage['time']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048, 4096, 8192])
+    parser.add_argument('--spacings', type=float, nargs='+', default=[12, 24],
+                        help='Distance between the atoms in pixels (lattice density)')
+    parser.add_argument('--sigmas', type=float, nargs='+', default=[2, 5])
+    parser.add_argument('--box-sizes', type=int, nargs='+', default=[16, 30])
+    parser.add_argument('--jitter', type=float, default=1.0, help='Standard deviation of the line shifts in pixels')
+    parser.add_argument('--noise-tolerance', type=float, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--fused', action='store_true', help='Run the y- and x-correction in one pass')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare the run times with')
+    parser.add_argument('--tolerance', type=float, default=1.2,
+                        help='Factor by which a stage has to be slower to count as regression')
+    args = parser.parse_args(argv)
+
+    results = []
+    for size, spacing, sigma, box_size in itertools.product(args.sizes, args.spacings, args.sigmas, args.box_sizes):
+        result = run_case(size, spacing, sigma, box_size, args.jitter, args.noise_tolerance, args.seed,
+                          fused=args.fused)
+        results.append(result)
+        print('size {:.0f}, spacing {:g}, sigma {:g}, box size {:.0f}: {:.2f} s, {:.0f} maxima, '
+              'line jitter {:.2f} -> {:.2f} px'.format(size, spacing, sigma, box_size, result['total_time'],
+                                                      result['number_maxima'], result['line_jitter_before'],
+                                                      result['line_jitter_after']))
+        for name, stage in result['stages'].items():
+            print('    {:25s} {:8.3f} s {:10.1f} MB {:4.0f} calls'.format(name, stage['time'],
+                                                                      (stage['peak_memory'] or 0)/1e6, stage['calls']))
+
+    environment = {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+                   'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+                   'kernel_backend': kernels.DEFAULT_BACKEND}
+    with open(args.output, 'w') as output_file:
+        json.dump({'environment': environment, 'results': results}, output_file, indent=2)
+    print('Results saved to ' + args.output)
+
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            previous_results = json.load(previous_file)['results']
+        if compare(results, previous_results, args.tolerance) > 0:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
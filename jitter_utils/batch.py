@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+Command line tool to dejitter many images without Nion Swift (installed as "jitterwizard").
+
+Example:
+    jitterwizard "data/*.npy" --sigma 5 --box-size 60 --output-dir dejittered --workers 4
+"""
+
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from . import correct_jitter
+from . import instrumentation
+
+EXTENSIONS = ('.npy', '.tif', '.tiff', '.h5', '.hdf5')
+MANIFEST_NAME = 'jitterwizard_manifest.json'
+
+def find_files(inputs):
+    # Files matching "inputs" (directories, glob patterns or file names) with one of EXTENSIONS, sorted
+    paths = []
+    for item in inputs:
+        if os.path.isdir(item):
+            candidates = [os.path.join(item, name) for name in os.listdir(item)]
+        else:
+            candidates = glob.glob(item)
+        paths.extend(path for path in candidates
+                     if os.path.isfile(path) and os.path.splitext(path)[1].lower() in EXTENSIONS)
+    return sorted(set(os.path.abspath(path) for path in paths))
+
+def file_hash(path, chunk_size=2**22):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as input_file:
+        for chunk in iter(lambda: input_file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_image(path, dataset=None):
+    # Reads a 2D image or a (T, H, W) stack of frames. tifffile and h5py are only needed for their file types.
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.npy':
+        return np.load(path)
+    if extension in ('.tif', '.tiff'):
+        import tifffile
+        return tifffile.imread(path)
+    if extension in ('.h5', '.hdf5'):
+        import h5py
+        with h5py.File(path, 'r') as h5file:
+            return h5file[dataset or _first_image_dataset(h5file)][...]
+    raise ValueError('Unsupported file type "{}". Possible types are: {}.'.format(extension, ', '.join(EXTENSIONS)))
+
+def write_image(path, image, dataset=None):
+    # Writes to a temporary file first, so that an interrupted run does not leave a truncated result
+    extension = os.path.splitext(path)[1].lower()
+    temporary_path = path + '.part' + extension
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if extension == '.npy':
+        np.save(temporary_path, image)
+    elif extension in ('.tif', '.tiff'):
+        import tifffile
+        tifffile.imwrite(temporary_path, image)
+    elif extension in ('.h5', '.hdf5'):
+        import h5py
+        with h5py.File(temporary_path, 'w') as h5file:
+            h5file.create_dataset(dataset or 'data', data=image)
+    else:
+        raise ValueError('Unsupported file type "{}". Possible types are: {}.'.format(extension,
+                                                                                   ', '.join(EXTENSIONS)))
+    os.replace(temporary_path, path)
+    return path
+
+def dejitter_image(image, sigma, noise_tolerance, box_size):
+    # Dejitters a single image or each frame of a (T, H, W) stack. Runs in the worker processes.
+    jitter = correct_jitter.Jitter(instrumentation=instrumentation.Instrumentation(logger=logging.getLogger(__name__)))
+    jitter.blur_radius = sigma
+    jitter.noise_tolerance = noise_tolerance
+    if image.ndim == 3:
+        corrected = np.empty_like(image)
+        for frame in jitter.dejitter_stack(image, box_size=box_size, out=corrected):
+            pass
+        return corrected
+    if image.ndim != 2:
+        raise ValueError('Images must be 2D or stacks of 2D frames, not of shape {}.'.format(image.shape))
+    jitter.image = image
+    return jitter.apply_correction(jitter.dejitter_full_image(box_size=box_size))
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+def save_manifest(output_dir, manifest):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.part', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+    os.replace(path + '.part', path)
+
+def output_path(path, output_dir, output_format=None, root=None):
+    # Path of the result for "path". With "root", the directories of "path" below "root" are recreated in
+    # "output_dir", so files with the same name in different directories do not overwrite each other.
+    directory, name = os.path.split(path)
+    name, extension = os.path.splitext(name)
+    if root is not None:
+        output_dir = os.path.normpath(os.path.join(output_dir, os.path.relpath(directory, root)))
+    return os.path.join(output_dir, name + '_dejittered' + (output_format or extension))
+
+def output_paths(paths, output_dir, output_format=None):
+    # Paths of the results for all "paths", relative to the directory that contains all of them. Raises ValueError
+    # if two files would still be written to the same path (e.g. "a.tif" and "a.npy" with the same output format).
+    paths = [os.path.abspath(path) for path in paths]
+    root = os.path.commonpath([os.path.dirname(path) for path in paths]) if paths else None
+    results = [output_path(path, output_dir, output_format, root=root) for path in paths]
+    sources = {}
+    for path, result_path in zip(paths, results):
+        if result_path in sources:
+            raise ValueError('{} and {} would both be written to {}.'.format(sources[result_path], path, result_path))
+        sources[result_path] = path
+    return results
+
+def run(paths, sigma, noise_tolerance, box_size, output_dir, workers=1, output_format=None, dataset=None,
+        force=False):
+    # Dejitters all "paths" into "output_dir" (see output_paths). Files whose content hash and parameters are in the
+    # manifest of "output_dir" (and whose result still exists) are skipped unless "force" is set. Files are hashed,
+    # read and written in threads while the correction runs in a pool of "workers" processes, so I/O and computation
+    # overlap. Returns the number of files that failed.
+    result_paths = output_paths(paths, output_dir, output_format)
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = load_manifest(output_dir)
+    parameters = {'sigma': sigma, 'noise_tolerance': noise_tolerance, 'box_size': box_size, 'dataset': dataset}
+    io_executor = ThreadPoolExecutor(max_workers=max(2, workers))
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    failed = 0
+    start = time.perf_counter()
+    try:
+        # Hashing and reading run up to "window" files ahead of the correction, results are written in the background
+        window = 2*workers
+        images = correct_jitter._bounded_map(io_executor, _hash_and_read, paths, result_paths,
+                                             [manifest.get(path) for path in paths],
+                                             *[[value]*len(paths) for value in (parameters, force, dataset)],
+                                             window=window)
+        if executor is not None:
+            results = correct_jitter._bounded_map(executor, _dejitter_or_exception, images,
+                                                  *[[value]*len(paths) for value in (sigma, noise_tolerance, box_size)],
+                                                  window=window)
+        else:
+            results = map(_dejitter_or_exception, images, *[[value]*len(paths)
+                                                            for value in (sigma, noise_tolerance, box_size)])
+        writes = []
+        processed = 0
+        for path, result_path, (content_hash, result) in zip(paths, result_paths, results):
+            if result is None:
+                print('Skipping {} (already dejittered)'.format(path))
+                continue
+            processed += 1
+            if isinstance(result, Exception):
+                failed += 1
+                print('Failed to dejitter {}: {}'.format(path, result))
+                continue
+            writes.append((path, content_hash, result_path,
+                           io_executor.submit(write_image, result_path, result, dataset)))
+            writes, failed_writes = _finish_writes(writes, manifest, parameters, output_dir)
+            failed += failed_writes
+        writes, failed_writes = _finish_writes(writes, manifest, parameters, output_dir, wait=True)
+        failed += failed_writes
+        print('Dejittered {:.0f} files in {:.1f} s'.format(processed - failed, time.perf_counter() - start))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        io_executor.shutdown()
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='Directories, glob patterns or files ({})'.format(
+                                                                                            ', '.join(EXTENSIONS)))
+    parser.add_argument('--sigma', type=float, default=5)
+    parser.add_argument('--noise-tolerance', type=float, default=1)
+    parser.add_argument('--box-size', type=float, default=60)
+    parser.add_argument('--output-dir', default='dejittered')
+    parser.add_argument('--output-format', choices=EXTENSIONS, help='File type of the results (default: same as input)')
+    parser.add_argument('--dataset', help='Dataset in .h5 files (default: the first one with at least 2 dimensions)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--force', action='store_true', help='Also process files that are in the manifest')
+    args = parser.parse_args(argv)
+    paths = find_files(args.inputs)
+    if not paths:
+        print('No files found.')
+        return 1
+    try:
+        failed = run(paths, args.sigma, args.noise_tolerance, args.box_size, args.output_dir, workers=args.workers,
+                     output_format=args.output_format, dataset=args.dataset, force=args.force)
+    except ValueError as error:
+        print(error)
+        return 1
+    return 1 if failed > 0 else 0
+
+def _first_image_dataset(h5file):
+    names = []
+    h5file.visititems(lambda name, item: names.append(name) if getattr(item, 'ndim', 0) >= 2 else None)
+    if not names:
+        raise ValueError('{} contains no dataset with at least 2 dimensions.'.format(h5file.filename))
+    return names[0]
+
+def _hash_and_read(path, result_path, entry, parameters, force, dataset):
+    # Read-ahead step of run. Returns the content hash and the image, or None instead of the image if "entry" (from
+    # the manifest) shows that the file was already dejittered with "parameters" into "result_path". Errors are
+    # returned instead of raised, so that one bad file does not stop the others.
+    try:
+        content_hash = file_hash(path)
+        if (not force and entry is not None and entry['hash'] == content_hash and
+                entry['parameters'] == parameters and entry['output'] == result_path and
+                os.path.exists(result_path)):
+            return content_hash, None
+        # The file was just hashed, so it is usually read from the page cache
+        return content_hash, read_image(path, dataset=dataset)
+    except Exception as exception:
+        return None, exception
+
+def _dejitter_or_exception(hash_and_image, sigma, noise_tolerance, box_size):
+    # Returns the content hash and the result, None for skipped files or the exception
+    content_hash, image = hash_and_image
+    if image is None or isinstance(image, Exception):
+        return content_hash, image
+    try:
+        return content_hash, dejitter_image(image, sigma, noise_tolerance, box_size)
+    except Exception as exception:
+        return content_hash, exception
+
+def _finish_writes(writes, manifest, parameters, output_dir, wait=False):
+    # Adds finished writes to the manifest (saved after every file, so an interrupted run can be continued). Returns
+    # the writes that are still running and the number of failed ones. With "wait" it waits for all writes.
+    running = []
+    failed = 0
+    for path, content_hash, result_path, future in writes:
+        if not wait and not future.done():
+            running.append((path, content_hash, result_path, future))
+            continue
+        try:
+            future.result()
+        except Exception as exception:
+            failed += 1
+            print('Failed to write {}: {}'.format(result_path, exception))
+            continue
+        manifest[path] = {'hash': content_hash, 'parameters': parameters, 'output': result_path}
+        save_manifest(output_dir, manifest)
+        print('Dejittered {} -> {}'.format(path, result_path))
+    return running, failed
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Gaussian blur implementations that can be selected for Jitter.blurred_image.
+"""
+
+import functools
+import numpy as np
+from scipy import ndimage
+from scipy import fft
+
+def gaussian_blur(image, sigma, backend='auto', truncate=4.0, output=None):
+    # Blurs "image" with the backend "backend" (one of BLUR_BACKENDS or 'auto'). All backends treat the image border
+    # like ndimage.gaussian_filter with mode='reflect'. "output" is only used by the ndimage based backends and only if
+    # it has the data type they calculate in.
+    if backend == 'auto':
+        backend = choose_blur_backend(np.shape(image), sigma)
+    if backend not in BLUR_BACKENDS:
+        raise ValueError('Unknown blur backend "{}". Possible values are: {}.'.format(backend,
+                                                                                   ', '.join(BLUR_BACKENDS)))
+    return BLUR_BACKENDS[backend](image, sigma, truncate=truncate, output=output)
+
+def choose_blur_backend(shape, sigma):
+    # The direct convolution gets slower with sigma while the FFT does not. The exact float64 version is kept where it
+    # is fast anyway, so that results do not change for typical parameters.
+    sigma = np.amax(sigma)
+    size = np.prod(shape)
+    if sigma < 3 or size < 512**2:
+        return 'ndimage'
+    if sigma < 8:
+        return 'float32'
+    return 'fft'
+
+def ndimage_blur(image, sigma, truncate=4.0, output=None):
+    # The reference implementation: direct separable convolution in float64
+    return ndimage.gaussian_filter(_filter_input(image, output, np.float64), sigma, truncate=truncate,
+                                   output=_filter_output(output, np.float64))
+
+def float32_blur(image, sigma, truncate=4.0, output=None):
+    # Direct separable convolution with float32 input and output, which halves the memory traffic
+    return ndimage.gaussian_filter(_filter_input(image, output, np.float32), sigma, truncate=truncate,
+                                   output=_filter_output(output, np.float32))
+
+def fft_blur(image, sigma, truncate=4.0, output=None):
+    # Convolution via a real FFT in float32. The image is padded by the kernel radius with reflected values (same as
+    # mode='reflect') and to a fast FFT length with zeros, which keeps the circular convolution from wrapping around.
+    image = np.asarray(image, dtype=np.float32)
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (image.ndim,))
+    radius = [int(truncate*s + 0.5) for s in sigma]
+    padded = np.pad(image, [(r, r) for r in radius], mode='symmetric')
+    fast_shape = (fft.next_fast_len(padded.shape[0]), fft.next_fast_len(padded.shape[1], real=True))
+    row_spectrum, column_spectrum = _gaussian_spectra(fast_shape, tuple(sigma), tuple(radius))
+    spectrum = fft.rfft2(padded, s=fast_shape)
+    spectrum *= row_spectrum[:, np.newaxis]
+    spectrum *= column_spectrum
+    blurred = fft.irfft2(spectrum, s=fast_shape)
+    return blurred[radius[0]:radius[0] + image.shape[0], radius[1]:radius[1] + image.shape[1]]
+
+def recursive_blur(image, sigma, truncate=4.0, output=None):
+    # Recursive (IIR) approximation of the Gaussian after Young and van Vliet (1995). The run time does not depend on
+    # sigma, but the kernel deviates from a Gaussian by a few percent of its peak, so this backend is never chosen
+    # automatically. Axes with sigma < 0.5, where the approximation does not hold, use the direct convolution.
+    from scipy import signal
+    blurred = np.array(image, dtype=np.float64)
+    sigma = np.broadcast_to(np.asarray(sigma, dtype=float), (blurred.ndim,))
+    for axis, axis_sigma in enumerate(sigma):
+        if axis_sigma < 0.5:
+            if axis_sigma > 0:
+                ndimage.gaussian_filter1d(blurred, axis_sigma, axis=axis, truncate=truncate, output=blurred)
+            continue
+        b, a = _young_van_vliet_coefficients(axis_sigma)
+        radius = int(truncate*axis_sigma + 0.5)
+        pad_width = [(0, 0)] * blurred.ndim
+        pad_width[axis] = (radius, radius)
+        padded = np.pad(blurred, pad_width, mode='symmetric')
+        zi_shape = [1] * blurred.ndim
+        zi_shape[axis] = len(a) - 1
+        zi = signal.lfilter_zi(b, a).reshape(zi_shape)
+        # Forward and backward pass, both started in the steady state of the first value
+        padded = signal.lfilter(b, a, padded, axis=axis, zi=zi*np.take(padded, [0], axis=axis))[0]
+        padded = np.flip(padded, axis=axis)
+        padded = signal.lfilter(b, a, padded, axis=axis, zi=zi*np.take(padded, [0], axis=axis))[0]
+        padded = np.flip(padded, axis=axis)
+        blurred = np.take(padded, np.arange(radius, radius + blurred.shape[axis]), axis=axis)
+    return blurred
+
+def _filter_output(output, dtype):
+    if output is not None and output.dtype != dtype:
+        return None
+    return output
+
+def _filter_input(image, output, dtype):
+    # With an output array, ndimage converts each value to float64 while filtering, which gives the same result as
+    # converting the image first if the conversion to "dtype" is exact. This saves a converted copy of the image.
+    image = np.asarray(image)
+    if _filter_output(output, dtype) is not None and np.can_cast(image.dtype, dtype):
+        return image
+    return np.asarray(image, dtype=dtype)
+
+@functools.lru_cache(maxsize=32)
+def _gaussian_spectra(shape, sigma, radius):
+    # Spectra of the 1D kernels (as used by ndimage.gaussian_filter) along the rows and columns for an FFT of size
+    # "shape"
+    spectra = []
+    for length, axis_sigma, axis_radius, transform in zip(shape, sigma, radius, (fft.fft, fft.rfft)):
+        kernel = np.zeros(length)
+        if axis_sigma > 0:
+            x = np.arange(-axis_radius, axis_radius + 1)
+            weights = np.exp(-0.5 / axis_sigma**2 * x**2)
+            kernel[x] = weights / weights.sum()
+        else:
+            kernel[0] = 1
+        spectra.append(transform(kernel).astype(np.complex64))
+    return tuple(spectra)
+
+def _young_van_vliet_coefficients(sigma):
+    if sigma >= 2.5:
+        q = 0.98711*sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554*np.sqrt(1 - 0.26891*sigma)
+    b0 = 1.57825 + 2.44413*q + 1.4281*q**2 + 0.422205*q**3
+    b1 = 2.44413*q + 2.85619*q**2 + 1.26661*q**3
+    b2 = -(1.4281*q**2 + 1.26661*q**3)
+    b3 = 0.422205*q**3
+    B = 1 - (b1 + b2 + b3)/b0
+    return np.array([B]), np.array([1, -b1/b0, -b2/b0, -b3/b0])
+
+BLUR_BACKENDS = {'ndimage': ndimage_blur,
+                 'float32': float32_blur,
+                 'fft': fft_blur,
+                 'recursive': recursive_blur}
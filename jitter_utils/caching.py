@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Caches for intermediate results that are shared between Jitter instances.
+"""
+
+import collections
+import hashlib
+import os
+import threading
+import numpy as np
+
+class LRUCache(object):
+    # Thread-safe dictionary that forgets the least recently used entries once it holds more than "maxsize" or, if
+    # "max_bytes" is set, once the arrays in it take more than "max_bytes"
+
+    def __init__(self, maxsize=8, max_bytes=None):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    @property
+    def nbytes(self):
+        return self._bytes
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= _nbytes(self._entries[key])
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._bytes += _nbytes(value)
+            while len(self._entries) > self.maxsize or (self.max_bytes is not None and self._bytes > self.max_bytes and
+                                                        len(self._entries) > 0):
+                self._bytes -= _nbytes(self._entries.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+def _nbytes(value):
+    return getattr(value, 'nbytes', 0)
+
+def image_hash(image):
+    # Hash of the content, shape and data type of "image"
+    image = np.ascontiguousarray(image)
+    digest = hashlib.sha1(str((image.shape, image.dtype.str)).encode())
+    digest.update(image.reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+class OffsetCache(object):
+    # Stores coordinate offsets (and the maxima they were calculated from) as compressed .npz files in "directory".
+    # Keys are tuples like (image hash, sigma, noise tolerance, box size, ...). Once the files take more than
+    # "max_bytes", the least recently used ones are deleted. Can be shared between processes and sessions.
+
+    def __init__(self, directory=None, max_bytes=2**30):
+        if directory is None:
+            directory = os.path.join(os.path.expanduser('~'), '.cache', 'jitterwizard')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(repr(key).encode()).hexdigest() + '.npz')
+
+    def get(self, key):
+        # Returns (coordinate offsets, maxima or None) or None if "key" is not in the cache
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                coordinate_offsets = entry['coordinate_offsets'].astype(str(entry['dtype']))
+                maxima = entry['maxima'] if 'maxima' in entry else None
+            # The modification time is used to find the least recently used files
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # Missing file or removed by another process in the meantime
+            return None
+        return coordinate_offsets, maxima
+
+    def put(self, key, coordinate_offsets, maxima=None):
+        # Integer offsets are stored in the smallest integer type that holds them
+        stored_offsets = np.asarray(coordinate_offsets)
+        if np.issubdtype(stored_offsets.dtype, np.integer) and stored_offsets.size > 0:
+            limit = max(-int(np.amin(stored_offsets)), int(np.amax(stored_offsets)))
+            for dtype in (np.int8, np.int16, np.int32):
+                if limit <= np.iinfo(dtype).max:
+                    stored_offsets = stored_offsets.astype(dtype)
+                    break
+        arrays = {'coordinate_offsets': stored_offsets, 'dtype': np.array(np.asarray(coordinate_offsets).dtype.str)}
+        if maxima is not None:
+            arrays['maxima'] = np.asarray(maxima, dtype=np.int32)
+        path = self.path(key)
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            # Written under a temporary name, so that other processes never read a partly written file
+            temporary_path = path[:-len('.npz')] + '.{:d}.part.npz'.format(os.getpid())
+            np.savez_compressed(temporary_path, **arrays)
+            os.replace(temporary_path, path)
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            for path in self._entries():
+                _remove(path)
+
+    def _entries(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith('.npz') and not name.endswith('.part.npz')]
+
+    def _evict(self):
+        entries = []
+        for path in self._entries():
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        total_size = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            _remove(path)
+            total_size -= size
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+# Caches used by Jitter.sweep(cache=True). Blurred images keyed on (image hash, overlap, blur steps), where the blur
+# steps are the (sigma, blur backend) pairs the image was blurred with one after the other.
+blurred_images = LRUCache(maxsize=8, max_bytes=2**30)
+# Arrays of local maxima keyed on (image hash, overlap, blur steps, noise tolerance)
+local_maxima = LRUCache(maxsize=32, max_bytes=2**28)
@@ -5,9 +5,21 @@ Created on Wed Dec 14 14:19:31 2016
 @author: mittelberger2
 """
 
+import collections
+import functools
+import logging
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy import fft
 from scipy import ndimage
-from AnalyzeMaxima import analyze_maxima
+from . import blur_backends
+from . import caching
+from . import instrumentation
+from . import kernels
+
+class DejitterCancelled(Exception):
+    # Raised at the next cancellation point after Jitter.cancel_event was set
+    pass
 
 class Jitter(object):
 
@@ -18,6 +30,25 @@ class Jitter(object):
         self._local_maxima = None
         self._raw_local_maxima = None
         self._noise_tolerance = None
+        # Jitter object and padded region used by dejitter_region
+        self._region_jitter = None
+        self._padded_region = None
+        self._image_hash = None
+        self._blur_backend = kwargs.get('blur_backend', 'auto')
+        # Stage timings, counters and progress messages (see instrumentation.Instrumentation)
+        self.instrumentation = kwargs.get('instrumentation')
+        if self.instrumentation is None:
+            self.instrumentation = instrumentation.Instrumentation()
+        # Any object with an is_set() method (e.g. threading.Event). Once it is set, the running calculation stops with
+        # DejitterCancelled at the next call of check_cancelled. Cached results stay valid.
+        self.cancel_event = kwargs.get('cancel_event')
+        # Optional caching.OffsetCache. dejitter_full_image then looks up the offsets of images it has seen before.
+        self.offset_cache = kwargs.get('offset_cache')
+        # How pixels in overlapping boxes are assigned to a box, see box_owner_map
+        self.overlap = kwargs.get('overlap', 'last')
+        # 'numba' runs the per-box loops in compiled parallel kernels, 'numpy' in NumPy (see kernels.py). The default
+        # is 'numba' if it is installed.
+        self.kernel_backend = kernels.check_backend(kwargs.get('kernel_backend', kernels.DEFAULT_BACKEND))
 
     @property
     def image(self):
@@ -29,14 +60,40 @@ class Jitter(object):
         self._blurred_image = None
         self._local_maxima = None
         self._raw_local_maxima = None
+        self._region_jitter = None
+        self._padded_region = None
+        self._image_hash = None
+
+    @property
+    def image_hash(self):
+        # Content hash of the image (see caching.image_hash), calculated once per image
+        if self._image_hash is None:
+            self._image_hash = caching.image_hash(self.image)
+        return self._image_hash
 
     @property
     def blurred_image(self):
         if self._blurred_image is None:
+            self.check_cancelled()
             #print('Calculating new blurred image')
-            self._blurred_image = ndimage.gaussian_filter(self.image.astype(np.float64), self._blur_radius)
+            with self.instrumentation.stage('gaussian_blur'):
+                self._blurred_image = blur_backends.gaussian_blur(self.image, self._blur_radius,
+                                                                  backend=self._blur_backend)
         return self._blurred_image
 
+    @property
+    def blur_backend(self):
+        # One of blur_backends.BLUR_BACKENDS or 'auto' to choose one depending on sigma and image size
+        return self._blur_backend
+
+    @blur_backend.setter
+    def blur_backend(self, blur_backend):
+        if blur_backend != self._blur_backend:
+            self._blurred_image = None
+            self._raw_local_maxima = None
+            self._local_maxima = None
+        self._blur_backend = blur_backend
+
     @property
     def blur_radius(self):
         return self._blur_radius
@@ -62,16 +119,47 @@ class Jitter(object):
     @property
     def raw_local_maxima(self):
         if self._raw_local_maxima is None:
-            self._raw_local_maxima = self.find_local_maxima()
+            # Blur first, so that the stages are timed separately
+            self.blurred_image
+            self.check_cancelled()
+            with self.instrumentation.stage('find_local_maxima'):
+                self._raw_local_maxima = self.find_local_maxima()
         return self._raw_local_maxima
 
     @property
     def local_maxima(self):
+        # The map of raw_local_maxima and the (N, 2) array of the maxima that stand out by more than noise_tolerance
         if self._local_maxima is None:
-            self._local_maxima = [self.raw_local_maxima[0],
-                                  self.analyze_and_mark_maxima(self.raw_local_maxima[1], self.noise_tolerance)]
+            raw_local_maxima = self.raw_local_maxima
+            self.check_cancelled()
+            with self.instrumentation.stage('analyze_and_mark_maxima'):
+                self._local_maxima = [raw_local_maxima[0],
+                                      self.analyze_and_mark_maxima(raw_local_maxima[1], self.noise_tolerance)]
+            self.instrumentation.count('maxima_found', len(self._local_maxima[1]))
+        elif self._local_maxima[0] is None:
+            # The maxima came from a cache or from track_maxima, the map is only calculated when it is needed
+            self._local_maxima[0] = self.raw_local_maxima[0]
         return self._local_maxima
 
+    @property
+    def maxima(self):
+        # Same as local_maxima[1], but without calculating the map if the maxima came from a cache or track_maxima
+        if self._local_maxima is None:
+            return self.local_maxima[1]
+        return self._local_maxima[1]
+
+    @property
+    def local_maxima_list(self):
+        # The maxima in local_maxima[1] as list of (y, x) tuples, which is what older code expects
+        return [tuple(maximum) for maximum in self.maxima.tolist()]
+
+    def check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise DejitterCancelled('The calculation was cancelled.')
+
+    def _use_kernels(self, image):
+        return self.kernel_backend == 'numba' and kernels.supports(image)
+
     def gaussian_blur(self, image=None, sigma=None):
         if image is not None:
             self.image = image
@@ -83,56 +171,36 @@ class Jitter(object):
         return self.blurred_image
 
     def find_local_maxima(self):
-        local_maxima = np.zeros(self.image.shape)
-        shape = self.image.shape
+        # Pixels that are at least as bright as all 8 neighbours (ties count as maximum), excluding the image border.
+        # Compares shifted views of the blurred image in place, so only two boolean images are allocated. Returns a
+        # map with the blurred values at the maxima and the (N, 2) array of their coordinates.
         blurred_image = self.blurred_image
-
-        # This is the fast version of the commented for-loops below
-        extended_blurred_image = np.empty(shape + (9,))
-        extended_blurred_image[..., 0] = blurred_image
-        y_positions = [(1, None), (0, -1), (0, None), (1, None), (0, -1), (0, None), (1, None), (0, -1)]
-        x_positions = [(0, None), (0, None), (1, None), (1, None), (1, None), (0, -1), (0, -1), (0, -1)]
-        mappings = {(0, None): (0, None), (1, None): (0, -1), (0, -1): (1, None)}
-        for i in range(8):
-            target_y = y_positions[i]
-            source_y = mappings[target_y]
-            target_x = x_positions[i]
-            source_x = mappings[target_x]
-            extended_blurred_image[..., i+1][target_y[0]:target_y[1], target_x[0]:target_x[1]] = (
-                                                    blurred_image[source_y[0]:source_y[1], source_x[0]:source_x[1]])
-
-        max_positions = np.argmax(extended_blurred_image, axis=-1)
-        local_maxima[max_positions == 0] = blurred_image[max_positions == 0]
-        local_maxima[0, :] = 0
-        local_maxima[-1, :] = 0
-        local_maxima[:, 0] = 0
-        local_maxima[:, -1] = 0
-
-#        y_positions = [1, -1, 0, 1, -1,  0,  1, -1]
-#        x_positions = [0,  0, 1, 1,  1, -1, -1, -1]
-#        for y in range(shape[0]):
-#            if y < 1 or y > shape[0] - 2:
-#                continue
-#            for x in range(shape[1]):
-#                if x < 1 or x > shape[1] - 2:
-#                    continue
-#                is_max = True
-#                for k in range(8):
-#                    if blurred_image[y, x] <= blurred_image[y + y_positions[k], x + x_positions[k]] + noise_tolerance:
-#                        is_max = False
-#                        break
-#                if is_max:
-#                    local_maxima[y,x] = blurred_image[y,x]
-        return local_maxima, list(zip(*np.where(local_maxima)))
+        shape = blurred_image.shape
+        center = blurred_image[1:-1, 1:-1]
+        is_maximum = center != 0
+        is_greater_equal = np.empty(is_maximum.shape, dtype=bool)
+        for y, x in [(1, 0), (-1, 0), (0, 1), (1, 1), (-1, 1), (0, -1), (1, -1), (-1, -1)]:
+            self.check_cancelled()
+            np.greater_equal(center, blurred_image[1+y:shape[0]-1+y, 1+x:shape[1]-1+x], out=is_greater_equal)
+            is_maximum &= is_greater_equal
+        local_maxima = np.zeros(shape)
+        local_maxima[1:-1, 1:-1][is_maximum] = center[is_maximum]
+        return local_maxima, np.argwhere(is_maximum) + 1
 
     def analyze_and_mark_maxima(self, maxima, noise_tolerance=0):
+        # Returns the maxima that stand out by more than "noise_tolerance" as (N, 2) array, brightest first
         blurred_image = self.blurred_image.ravel().astype(np.float32)
         shape = self.blurred_image.shape
-        sorted_maxima = maxima.copy()
-        sorted_maxima.sort(key=lambda entry: self.blurred_image[entry], reverse=True)
+        maxima = np.array(maxima, dtype=np.intp).reshape(-1, 2)
+        flat_maxima = maxima[:, 0] * shape[1] + maxima[:, 1]
+        # Stable sort in descending order, so maxima with the same value stay in their original order
+        order = np.argsort(-self.blurred_image.ravel()[flat_maxima], kind='mergesort')
+        flattened_array_sorted_maxima = flat_maxima[order].astype(np.uintc)
+        analyze_maxima = _analyze_maxima_extension()
+        if analyze_maxima is None:
+            resulting_maxima = analyze_maxima_numpy(blurred_image.reshape(shape), flat_maxima[order], noise_tolerance)
+            return np.stack(np.divmod(resulting_maxima, shape[1]), axis=-1)
         resulting_maxima = []
-        array_sorted_maxima = np.array(sorted_maxima, dtype=np.uintc)
-        flattened_array_sorted_maxima = array_sorted_maxima[:, 0] * shape[1] + array_sorted_maxima[:, 1]
         analyze_maxima.analyze_maxima(blurred_image, shape, flattened_array_sorted_maxima, resulting_maxima, noise_tolerance)
         #y_positions = [1, -1, 0, 1, -1,  0,  1, -1]
         #x_positions = [0,  0, 1, 1,  1, -1, -1, -1]
@@ -199,10 +267,7 @@ class Jitter(object):
 #                resulting_maxima.append(maximum)
 #        print(runtime)
 #        print('Number loop rounds: ' + str(numberlooprounds))
-        converted_resulting_maxima = []
-        for maximum in resulting_maxima:
-            converted_resulting_maxima.append((maximum//shape[1], maximum%shape[1]))
-        return converted_resulting_maxima
+        return np.stack(np.divmod(np.array(resulting_maxima, dtype=np.intp), shape[1]), axis=-1)
 
 
     def remove_y_jitter(self, crop_im, return_coordinates=False, mask=None):
@@ -257,52 +322,507 @@ class Jitter(object):
             pass
         return x_corrected_crop_im
 
-    def dejitter_full_image(self, box_size=60):
+    def remove_y_jitter_batch(self, crop_stack, mask=None):
+        # Vectorized version of remove_y_jitter(..., return_coordinates=True) for a stack of boxes with shape
+        # (N, box_height, box_width). Returns the row each box row has to be taken from, shape (N, box_height).
+        # Masked pixels keep their original row, this has to be handled by the caller.
+        return _row_sources(_masked_row_means(crop_stack, mask))
+
+    def remove_x_jitter_com_batch(self, crop_stack, mask=None):
+        # Vectorized version of remove_x_jitter_com(..., return_coordinates=True) for a stack of boxes with shape
+        # (N, box_height, box_width). Returns the shift of each box row, shape (N, box_height). Rows without any
+        # signal are not shifted.
+        if mask is not None:
+            crop_stack = np.where(mask, crop_stack.dtype.type(0), crop_stack)
+        weighted_sum = np.sum(np.arange(crop_stack.shape[2])*crop_stack, axis=-1)
+        total_sum = np.sum(crop_stack, axis=-1)
+        return _row_shifts(weighted_sum, total_sum, crop_stack.shape[2])
+
+    def correct_y_jitter(self, image, corners, owners, mask, y_offsets):
+        # Writes the row offsets of all pixels that belong to one of the boxes with upper left corners "corners"
+        # into "y_offsets". "owners" is the result of box_owner_map for these boxes.
+        if self._use_kernels(image):
+            row_sources = _row_sources(kernels.box_row_means(image, corners, mask))
+            self.check_cancelled()
+            kernels.write_y_offsets(row_sources, corners, owners, mask, y_offsets)
+            return
+        row_sources = np.empty((len(corners), mask.shape[0]), dtype=np.intp)
+        for batch in _box_batches(len(corners), mask.shape):
+            self.check_cancelled()
+            crop_stack = extract_boxes(image, corners[batch], mask.shape)
+            row_sources[batch] = self.remove_y_jitter_batch(crop_stack, mask=mask)
+        for rows, cols, box_index, box_rows, box_cols in _owned_pixels(owners, corners):
+            self.check_cancelled()
+            new_y_coords = np.where(mask[box_rows, box_cols], box_rows, row_sources[box_index, box_rows])
+            y_offsets[rows, cols] = corners[box_index, 0] + new_y_coords - rows
+
+    def correct_x_jitter(self, y_corrected, corners, owners, mask, x_offsets):
+        # Same as correct_y_jitter for the column offsets. "y_corrected" must be the y-corrected image with its
+        # minimum subtracted. Sub-pixel shifts are only kept if "x_offsets" is a float array.
+        if self._use_kernels(y_corrected):
+            row_shifts = _row_shifts(*kernels.box_row_sums(y_corrected, corners, mask), mask.shape[1])
+            self._write_x_offsets(row_shifts, corners, owners, mask, x_offsets)
+            return
+        row_shifts = np.empty((len(corners), mask.shape[0]))
+        for batch in _box_batches(len(corners), mask.shape):
+            self.check_cancelled()
+            crop_stack = extract_boxes(y_corrected, corners[batch], mask.shape)
+            row_shifts[batch] = self.remove_x_jitter_com_batch(crop_stack, mask=mask)
+        self._write_x_offsets(row_shifts, corners, owners, mask, x_offsets)
+
+    def correct_x_jitter_fused(self, image, y_offsets, corners, owners, mask, x_offsets):
+        # Same result as correct_x_jitter, but takes the uncorrected image and the y-offsets instead of the y-corrected
+        # image. The boxes are gathered from "image" through "y_offsets" batch by batch and the minimum is found in
+        # strips, so the full y-corrected image is never built.
+        minimum = y_corrected_minimum(image, y_offsets)
+        if self._use_kernels(image):
+            row_shifts = _row_shifts(*kernels.box_row_sums(image, corners, mask, y_offsets=y_offsets, minimum=minimum),
+                                     mask.shape[1])
+            self._write_x_offsets(row_shifts, corners, owners, mask, x_offsets)
+            return
+        row_shifts = np.empty((len(corners), mask.shape[0]))
+        for batch in _box_batches(len(corners), mask.shape):
+            self.check_cancelled()
+            crop_stack = extract_y_corrected_boxes(image, y_offsets, corners[batch], mask.shape)
+            crop_stack -= minimum
+            row_shifts[batch] = self.remove_x_jitter_com_batch(crop_stack, mask=mask)
+        self._write_x_offsets(row_shifts, corners, owners, mask, x_offsets)
+
+    def _write_x_offsets(self, row_shifts, corners, owners, mask, x_offsets):
+        self.check_cancelled()
+        if self._use_kernels(x_offsets):
+            kernels.write_x_offsets(row_shifts, corners, owners, mask, x_offsets)
+            return
+        for rows, cols, box_index, box_rows, box_cols in _owned_pixels(owners, corners):
+            self.check_cancelled()
+            new_x_coords = np.where(mask[box_rows, box_cols], box_cols, box_cols + row_shifts[box_index, box_rows])
+            new_x_coords = corners[box_index, 1] + new_x_coords
+            if np.issubdtype(x_offsets.dtype, np.integer):
+                # Conversion to int truncates like the assignment to an integer coordinate array did before
+                new_x_coords = new_x_coords.astype(np.intp)
+            x_offsets[rows, cols] = new_x_coords - cols
+
+    def dejitter_full_image(self, box_size=60, workers=None, tile=None, out=None, subpixel=False, fused=False):
+        # With "workers" or "tile" set, the image is processed in overlapping tiles (see dejitter_tiled).
+        # "out" can be a preallocated array of shape (2,) + image.shape for the offsets. With "subpixel" the offsets
+        # are float32 and keep the sub-pixel x-shifts (use apply_correction with order > 0 for these). With "fused"
+        # the x-correction reads the boxes through the y-offsets (see correct_x_jitter_fused) instead of from a
+        # y-corrected copy of the image. Both give the same offsets, fused needs less memory but is a bit slower.
+        if self.offset_cache is not None:
+            blur_backend = self._blur_backend
+            if blur_backend == 'auto':
+                blur_backend = blur_backends.choose_blur_backend(self.image.shape, self._blur_radius)
+            # Tiles give the same offsets as the full image, except for small differences with some blur backends
+            # (see _tile_maxima), so the tiling is part of the key
+            tiling = None
+            if workers is not None or tile is not None:
+                tiling = (workers, None if tile is None else tuple(np.broadcast_to(tile, (2,)).astype(float).tolist()))
+            # The key is hashed via its repr, so numbers are converted to float (e.g. sigma 5 and 5.0 give the same key)
+            sigma = tuple(np.broadcast_to(np.asarray(self._blur_radius, dtype=float), (self.image.ndim,)).tolist())
+            cache_key = (self.image_hash, sigma, float(self._noise_tolerance), float(box_size), bool(subpixel),
+                         blur_backend, self.overlap, tiling, self.kernel_backend)
+            cached = self.offset_cache.get(cache_key)
+            if cached is not None:
+                self.instrumentation.message('Using cached offsets')
+                coordinate_offsets, maxima = cached
+                if maxima is not None and self._local_maxima is None:
+                    self._local_maxima = [None, maxima.astype(np.intp)]
+                if out is not None:
+                    out[...] = coordinate_offsets
+                    return out
+                return coordinate_offsets
+            coordinate_offsets = self._dejitter(box_size, workers, tile, out, subpixel, fused)
+            maxima = self._local_maxima[1] if self._local_maxima is not None else None
+            self.offset_cache.put(cache_key, coordinate_offsets, maxima)
+            return coordinate_offsets
+        return self._dejitter(box_size, workers, tile, out, subpixel, fused)
+
+    def _dejitter(self, box_size, workers, tile, out, subpixel, fused):
+        if workers is not None or tile is not None:
+            return self.dejitter_tiled(box_size=box_size, workers=workers, tile=tile, out=out, subpixel=subpixel)
         half_box_size = int(box_size/2)
-        if box_size%2 == 0:
-            box_size = int(box_size + 1)
-        else:
-            box_size = int(box_size)
-        mask = np.ones((box_size, box_size), dtype=np.bool)
-        draw_circle(mask, (half_box_size, half_box_size), half_box_size, color=False)
-        mask = mask[:-1, :-1]
+        mask = make_box_mask(box_size)
         shape = self.image.shape
-        coordinate_offsets = np.mgrid[0:shape[0], 0:shape[1]]
-        print('Finding maxima')
-        local_maxima = self.local_maxima[1]
-        print('correcting y-jitter')
-        for maximum in local_maxima:
-            max_array = np.array(maximum)
-            if (max_array < half_box_size).any() or (max_array >= np.array(shape) - half_box_size - 1).any():
-                continue
-            chunk = (maximum[0]-half_box_size, maximum[0]+half_box_size, maximum[1]-half_box_size, maximum[1]+half_box_size)
-            new_y_coords = self.remove_y_jitter(self.image[chunk[0]:chunk[1], chunk[2]:chunk[3]], return_coordinates=True, mask=mask)
-            new_y_coords = maximum[0] - half_box_size + new_y_coords
-            #new_y_coords = new_y_coords - half_box_size
-            coordinate_offsets[0][chunk[0]:chunk[1], chunk[2]:chunk[3]] = new_y_coords
-        coordinate_offsets -= np.mgrid[0:shape[0], 0:shape[1]]
-        y_corrected = self.apply_correction(coordinate_offsets)
-        y_corrected -= np.amin(y_corrected)
-        coordinate_offsets += np.mgrid[0:shape[0], 0:shape[1]]
-        print('correcting x-jitter')
-        for maximum in local_maxima:
-            max_array = np.array(maximum)
-            if (max_array < half_box_size).any() or (max_array >= np.array(shape) - half_box_size - 1).any():
-                continue
-            chunk = (maximum[0]-half_box_size, maximum[0]+half_box_size, maximum[1]-half_box_size, maximum[1]+half_box_size)
-            new_x_coords = self.remove_x_jitter_com(y_corrected[chunk[0]:chunk[1], chunk[2]:chunk[3]], return_coordinates=True, mask=mask)
-            new_x_coords = maximum[1] - half_box_size + new_x_coords
-            #new_x_coords = new_x_coords - half_box_size
-            coordinate_offsets[1][chunk[0]:chunk[1], chunk[2]:chunk[3]] = new_x_coords
-        coordinate_offsets -= np.mgrid[0:shape[0], 0:shape[1]]
-        print('Done')
+        if out is None:
+            coordinate_offsets = np.zeros((2,) + shape, dtype=np.float32 if subpixel else int)
+        else:
+            coordinate_offsets = out
+            coordinate_offsets[...] = 0
+        self.instrumentation.message('Finding maxima')
+        maxima = self.maxima
+        with self.instrumentation.stage('box_owner_map'):
+            corners = box_corners(maxima, shape, half_box_size)
+            # Each pixel is corrected by exactly one box, depending on self.overlap
+            owners = box_owner_map(shape, corners, mask.shape, overlap=self.overlap)
+        self.instrumentation.count('boxes_corrected', len(corners))
+        self.instrumentation.count('boxes_skipped_at_border', len(maxima) - len(corners))
+        self.check_cancelled()
+        self.instrumentation.message('correcting y-jitter')
+        with self.instrumentation.stage('correct_y_jitter'):
+            self.correct_y_jitter(self.image, corners, owners, mask, coordinate_offsets[0])
+        self.instrumentation.message('correcting x-jitter')
+        # The kernels read the boxes through the y-offsets at no extra cost, so they always use the fused version
+        if fused or self._use_kernels(self.image):
+            with self.instrumentation.stage('correct_x_jitter'):
+                self.correct_x_jitter_fused(self.image, coordinate_offsets[0], corners, owners, mask,
+                                            coordinate_offsets[1])
+        else:
+            y_corrected = self.apply_correction(coordinate_offsets)
+            y_corrected -= np.amin(y_corrected)
+            with self.instrumentation.stage('correct_x_jitter'):
+                self.correct_x_jitter(y_corrected, corners, owners, mask, coordinate_offsets[1])
+        self.instrumentation.message('Done')
+        return coordinate_offsets
+
+    def dejitter_tiled(self, box_size=60, workers=None, tile=None, out=None, subpixel=False):
+        # Tiled version of dejitter_full_image. The tiles are processed with a halo large enough that the result does
+        # not depend on the tile borders. This runs in three rounds: the maxima of all tiles are collected first,
+        # because the flood fill in analyze_and_mark_maxima is not local (see _tile_maxima), the y-correction of a
+        # tile needs the maxima of its neighbours and the x-correction needs the minimum of the full y-corrected
+        # image. With "workers" > 1 the tiles are processed in a process pool. "tile" is the tile size (int or
+        # (height, width)), "out" an optional array of shape (2,) + image.shape (e.g. a np.memmap) for the offsets.
+        # "subpixel" works like in dejitter_full_image.
+        if self.image is None or self._blur_radius is None:
+            raise ValueError('You must set image and sigma in order to dejitter the image.')
+        image = np.asarray(self.image)
+        shape = image.shape
+        halo = tile_halo(box_size, self._blur_radius)
+        if tile is None:
+            tile = max(int(np.ceil(np.sqrt(shape[0]*shape[1]/max(workers or 1, 1)))), 2*halo)
+        tile = np.broadcast_to(tile, (2,)).astype(int)
+        tiles = list(_tiles(shape, tile, halo))
+        executor = ProcessPoolExecutor(max_workers=workers) if workers is not None and workers > 1 else None
+        if executor is not None:
+            map_function = functools.partial(_bounded_map, executor, window=2*workers)
+        else:
+            map_function = map
+        try:
+            if out is None:
+                coordinate_offsets = np.zeros((2,) + shape, dtype=np.float32 if subpixel else int)
+            else:
+                coordinate_offsets = out
+            self.instrumentation.message('Finding maxima in {:.0f} tiles'.format(len(tiles)))
+            # The backend has to be chosen for the full image, tiles are smaller
+            blur_backend = self._blur_backend
+            if blur_backend == 'auto':
+                blur_backend = blur_backends.choose_blur_backend(shape, self._blur_radius)
+            with self.instrumentation.stage('tiled_maxima'):
+                maxima = self._tiled_maxima(image, tiles, tile, halo, blur_backend, map_function)
+                corners = box_corners(maxima, shape, int(box_size/2))
+            self.instrumentation.count('maxima_found', len(maxima))
+            self.instrumentation.count('boxes_corrected', len(corners))
+            self.instrumentation.count('boxes_skipped_at_border', len(maxima) - len(corners))
+            box_shape = make_box_mask(box_size).shape
+            self.instrumentation.message('correcting y-jitter')
+            with self.instrumentation.stage('tiled_y_jitter'):
+                y_results = map_function(_tile_y_jitter, (image[padded] for core, padded in tiles),
+                                         (_tile_boxes(corners, box_shape, core, padded, self.overlap)
+                                          for core, padded in tiles),
+                                         tiles, [box_size]*len(tiles), [self.overlap]*len(tiles),
+                                         [self.kernel_backend]*len(tiles))
+                minima = []
+                for (core, padded), (y_offsets, minimum) in zip(tiles, y_results):
+                    self.check_cancelled()
+                    coordinate_offsets[0][core] = y_offsets
+                    minima.append(minimum)
+            self.instrumentation.message('correcting x-jitter')
+            with self.instrumentation.stage('tiled_x_jitter'):
+                x_results = map_function(_tile_x_jitter, (image[padded] for core, padded in tiles),
+                                         (coordinate_offsets[0][padded] for core, padded in tiles),
+                                         (_tile_boxes(corners, box_shape, core, padded, self.overlap)
+                                          for core, padded in tiles),
+                                         tiles, [min(minima)]*len(tiles), [box_size]*len(tiles),
+                                         [coordinate_offsets.dtype]*len(tiles), [self.overlap]*len(tiles),
+                                         [self.kernel_backend]*len(tiles))
+                for (core, padded), x_offsets in zip(tiles, x_results):
+                    self.check_cancelled()
+                    coordinate_offsets[1][core] = x_offsets
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        self.instrumentation.message('Done')
         return coordinate_offsets
 
-    def apply_correction(self, coordinate_offsets):
-        new_coordinates = np.mgrid[0:self.image.shape[0], 0:self.image.shape[1]].astype(np.float32)
-        new_coordinates += coordinate_offsets
-        corrected = self.image[new_coordinates[0].astype(np.int), new_coordinates[1].astype(np.int)]
-        return corrected.copy()
+    def _tiled_maxima(self, image, tiles, tile, halo, blur_backend, map_function):
+        # Maxima of the full image as (N, 2) array in the order of analyze_and_mark_maxima, found tile by tile (see
+        # _tile_maxima). Maxima whose region could not be decided in their tile are checked again in tiles of twice
+        # the size and halo until they are decided, at the latest in a tile that covers the full image. Depending on
+        # the noise tolerance the regions can be large, so the last round can need as much memory as the full image.
+        shape = image.shape
+        arguments = [[value]*len(tiles) for value in (shape, self._blur_radius, self._noise_tolerance, blur_backend)]
+        results = map_function(_tile_maxima, (image[padded] for core, padded in tiles), tiles, *arguments)
+        maxima = []
+        values = []
+        region_keys = []
+        undecided = []
+        while True:
+            for tile_maxima, status, tile_values, tile_keys in results:
+                self.check_cancelled()
+                decided = status == 1
+                maxima.append(tile_maxima[decided])
+                values.append(tile_values[decided])
+                region_keys.append(tile_keys[decided])
+                undecided.append(tile_maxima[~decided])
+            undecided = np.concatenate(undecided)
+            if len(undecided) == 0:
+                break
+            tile = 2*tile
+            halo = 2*halo
+            tiles = []
+            candidates = []
+            for core, padded in _tiles(shape, tile, halo):
+                in_core = np.all((undecided >= (core[0].start, core[1].start)) &
+                                 (undecided < (core[0].stop, core[1].stop)), axis=1)
+                if np.any(in_core):
+                    tiles.append((core, padded))
+                    candidates.append(undecided[in_core])
+            self.instrumentation.message('Checking {:.0f} maxima again in {:.0f} larger tiles'.format(len(undecided),
+                                                                                                     len(tiles)))
+            arguments = [[value]*len(tiles) for value in (shape, self._blur_radius, self._noise_tolerance,
+                                                          blur_backend)]
+            results = map_function(_tile_maxima, (image[padded] for core, padded in tiles), tiles, *arguments,
+                                   candidates)
+            undecided = []
+        maxima = np.concatenate(maxima)
+        values = np.concatenate(values)
+        region_keys = np.concatenate(region_keys)
+        # Same order as analyze_and_mark_maxima returns for the full image: by value, then by position
+        order = np.lexsort((maxima[:, 0]*shape[1] + maxima[:, 1], -values))
+        return maxima[order][_first_in_region(region_keys[order])]
+
+    def dejitter_lines(self, max_shift=16, smoothing=8, subpixel=False, out=None):
+        # Alternative to dejitter_full_image that does not need maxima, for images with few or no features (e.g.
+        # amorphous regions). The x-shift of each scan line is estimated by cross-correlation with the line before
+        # (see line_shifts), the y-offsets are zero. Returns offsets in the same format as dejitter_full_image. The
+        # lines are blurred along x with sigma (if set), which makes the estimate much less sensitive to noise.
+        # "max_shift" is the largest shift between two lines that is detected, shifts that stay the same for much
+        # longer than "smoothing" lines (e.g. drift or a tilted lattice) are kept. "out" and "subpixel" work like in
+        # dejitter_full_image.
+        if self.image is None:
+            raise ValueError('You must set image in order to dejitter the image.')
+        self.instrumentation.message('estimating line shifts')
+        with self.instrumentation.stage('line_jitter'):
+            shifts = line_shifts(self.image, max_shift=max_shift, smoothing=smoothing, sigma=self._blur_radius or 0,
+                                 cancel=self.check_cancelled)
+        if out is None:
+            coordinate_offsets = np.zeros((2,) + self.image.shape, dtype=np.float32 if subpixel else int)
+        else:
+            coordinate_offsets = out
+            coordinate_offsets[0] = 0
+        if not np.issubdtype(coordinate_offsets.dtype, np.floating):
+            shifts = np.rint(shifts)
+        coordinate_offsets[1] = shifts[:, np.newaxis]
+        return coordinate_offsets
+
+    def dejitter_region(self, region, box_size=60, order=0):
+        # Dejitters only "region" (tuple of two slices) of the image, e.g. for a quick preview, and returns the
+        # corrected region. Only the maxima in the region and in a halo around it are used (see tile_halo). The result
+        # can differ slightly from the same region of dejitter_full_image, because the x-correction there subtracts the
+        # minimum of the full y-corrected image. The blurred image and maxima of the padded region are kept, so
+        # changing only box_size or moving the region within the padded region does not search for maxima again.
+        if self.image is None or self._blur_radius is None:
+            raise ValueError('You must set image and sigma in order to dejitter a region.')
+        shape = self.image.shape
+        region = tuple(slice(*region_slice.indices(length)[:2]) for region_slice, length in zip(region, shape))
+        if any(region_slice.stop <= region_slice.start for region_slice in region):
+            raise ValueError('The region must not be empty.')
+        halo = tile_halo(box_size, self._blur_radius)
+        padded = tuple(slice(max(region_slice.start - halo, 0), min(region_slice.stop + halo, length))
+                       for region_slice, length in zip(region, shape))
+        if self._padded_region is None or not all(cached.start <= new.start and cached.stop >= new.stop
+                                                  for cached, new in zip(self._padded_region, padded)):
+            self._region_jitter = Jitter(instrumentation=self.instrumentation, overlap=self.overlap,
+                                         kernel_backend=self.kernel_backend)
+            self._region_jitter.image = np.asarray(self.image[padded])
+            self._padded_region = padded
+        jitter = self._region_jitter
+        jitter.cancel_event = self.cancel_event
+        jitter.overlap = self.overlap
+        # The backend is chosen for the full image, so that the preview matches the full correction
+        if self._blur_backend == 'auto':
+            jitter.blur_backend = blur_backends.choose_blur_backend(shape, self._blur_radius)
+        else:
+            jitter.blur_backend = self._blur_backend
+        jitter.blur_radius = self._blur_radius
+        jitter.noise_tolerance = self._noise_tolerance
+        coordinate_offsets = jitter.dejitter_full_image(box_size=box_size, subpixel=order > 0)
+        corrected = jitter.apply_correction(coordinate_offsets, order=order)
+        return corrected[_core_in_tile(region, self._padded_region)]
+
+    def dejitter_out_of_core(self, image, box_size=60, offsets=None, corrected=None, strip_height=512, workers=None):
+        # Dejitters an image that does not fit into memory. "image" can be a (memory mapped) array or the path of a
+        # .npy file which will be memory mapped. "offsets" and "corrected" receive the coordinate offsets and the
+        # corrected image. They can be arrays (e.g. np.memmap), paths of .npy files that are created as memory mapped
+        # files or None to keep the results in memory. All intermediate results are calculated in strips of
+        # "strip_height" rows, so the memory usage only depends on the strip size and not on the image size.
+        if isinstance(image, str):
+            image = np.load(image, mmap_mode='r')
+        self.image = image
+        offsets = _open_output(offsets, (2,) + image.shape, int)
+        corrected = _open_output(corrected, image.shape, image.dtype)
+        self.dejitter_tiled(box_size=box_size, workers=workers, tile=(strip_height, image.shape[1]), out=offsets)
+        self.instrumentation.message('applying correction')
+        with self.instrumentation.stage('apply_correction'):
+            apply_correction_in_strips(image, offsets, corrected, strip_height=strip_height)
+        return offsets, corrected
+
+    def sweep(self, sigmas, noise_tolerances, box_sizes, workers=None, keep_offsets=True, cache=False):
+        # Runs dejitter_full_image for all combinations of the parameters in a thread pool and returns a list of
+        # dictionaries with the parameters, the coordinate offsets and the score of the corrected image (see
+        # jitter_score, lower is better). The blurred images are calculated incrementally from the next smaller sigma.
+        # They are only kept during the sweep, unless "cache" is set: then they and the maxima are also stored in the
+        # caches of the caching module, so repeated sweeps over similar parameters are fast.
+        if self.image is None:
+            raise ValueError('You must set image in order to run a parameter sweep.')
+        key = caching.image_hash(self.image) if cache else None
+        blurred_images = {}
+        # The (sigma, blur backend) pairs each blurred image was calculated with, one after the other
+        blur_steps = {}
+        steps = ()
+        previous_sigma = 0
+        previous_blurred_image = np.asarray(self.image, dtype=np.float64)
+        for sigma in sorted(set(sigmas)):
+            # Blurring with sigma1 and then with sigma2 is the same as blurring with sqrt(sigma1**2 + sigma2**2)
+            step_sigma = np.sqrt(sigma**2 - previous_sigma**2)
+            blur_backend = self._blur_backend
+            if blur_backend == 'auto':
+                blur_backend = blur_backends.choose_blur_backend(self.image.shape, step_sigma)
+            steps += ((sigma, blur_backend),)
+            blurred_image = caching.blurred_images.get((key, self.overlap, steps)) if cache else None
+            if blurred_image is None:
+                blurred_image = blur_backends.gaussian_blur(previous_blurred_image, step_sigma, backend=blur_backend)
+                if cache:
+                    caching.blurred_images.put((key, self.overlap, steps), blurred_image)
+            blurred_images[sigma] = blurred_image
+            blur_steps[sigma] = steps
+            previous_sigma = sigma
+            previous_blurred_image = blurred_image
+
+        def find_maxima(sigma, noise_tolerance):
+            jitter = Jitter(blur_backend=self._blur_backend, cancel_event=self.cancel_event, overlap=self.overlap,
+                            kernel_backend=self.kernel_backend, instrumentation=self.instrumentation)
+            jitter.image = self.image
+            jitter.blur_radius = sigma
+            jitter.noise_tolerance = noise_tolerance
+            jitter._blurred_image = blurred_images[sigma]
+            maxima = None
+            if cache:
+                maxima_key = (key, self.overlap, blur_steps[sigma], noise_tolerance)
+                maxima = caching.local_maxima.get(maxima_key)
+            if maxima is None:
+                # Found here once, so that the box sizes that run in parallel on this Jitter all use them
+                maxima = jitter.maxima
+                if cache:
+                    caching.local_maxima.put(maxima_key, maxima)
+            else:
+                jitter._local_maxima = [None, maxima]
+            return jitter
+
+        def dejitter(jitter, box_size):
+            coordinate_offsets = jitter.dejitter_full_image(box_size=box_size)
+            result = {'sigma': jitter.blur_radius, 'noise_tolerance': jitter.noise_tolerance, 'box_size': box_size,
+                      'number_maxima': len(jitter.maxima),
+                      'score': jitter_score(jitter.apply_correction(coordinate_offsets))}
+            if keep_offsets:
+                result['coordinate_offsets'] = coordinate_offsets
+            return result
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            parameters = [(sigma, noise_tolerance) for sigma in sigmas for noise_tolerance in noise_tolerances]
+            jitters = list(executor.map(lambda arguments: find_maxima(*arguments), parameters))
+            return list(executor.map(lambda arguments: dejitter(*arguments),
+                                     [(jitter, box_size) for jitter in jitters for box_size in box_sizes]))
+
+    def track_maxima(self, maxima, search_radius=3):
+        # Moves each of "maxima" to the brightest pixel of the blurred image within "search_radius" pixels and returns
+        # them as (N, 2) array in the same order as analyze_and_mark_maxima. Maxima that end up at the same position
+        # are merged.
+        maxima = np.array(maxima, dtype=np.intp).reshape(-1, 2)
+        blurred_image = self.blurred_image
+        shape = blurred_image.shape
+        window = (min(2*search_radius + 1, shape[0]), min(2*search_radius + 1, shape[1]))
+        corners = np.clip(maxima - search_radius, 0, np.array(shape) - window)
+        brightest = np.argmax(extract_boxes(blurred_image, corners, window).reshape(len(corners), -1), axis=1)
+        flat_maxima = np.unique((corners[:, 0] + brightest//window[1])*shape[1] + corners[:, 1] + brightest%window[1])
+        values = blurred_image.ravel()[flat_maxima]
+        flat_maxima = flat_maxima[np.lexsort((flat_maxima, -values))]
+        return np.stack((flat_maxima//shape[1], flat_maxima%shape[1]), axis=1)
+
+    def dejitter_stack(self, frames, box_size=60, track_maxima=False, search_radius=3, order=0, out=None):
+        # Generator that dejitters a series of frames (any iterable of 2D arrays, e.g. a (T, H, W) memmap) and yields
+        # the corrected frames one by one. The buffers for the blurred image and the offsets are allocated once and
+        # reused for all frames of the same shape. With "track_maxima" the maxima of each frame are found by
+        # following the maxima of the previous frame (see track_maxima) instead of searching the full frame again.
+        # "order" is passed to apply_correction. If "out" is given (an array of shape (T, H, W)), frame i is written
+        # to out[i] and that is yielded, so no new arrays are allocated for the results.
+        if self._blur_radius is None:
+            raise ValueError('You must set sigma in order to dejitter frames.')
+        buffers = None
+        maxima = None
+        for index, frame in enumerate(frames):
+            self.check_cancelled()
+            frame = np.asarray(frame)
+            if buffers is None or buffers['coordinate_offsets'].shape[1:] != frame.shape:
+                blur_backend = self._blur_backend
+                if blur_backend == 'auto':
+                    blur_backend = blur_backends.choose_blur_backend(frame.shape, self._blur_radius)
+                # Only the ndimage based backends write into an output array, each in its own data type
+                blur_dtype = {'ndimage': np.float64, 'float32': np.float32}.get(blur_backend)
+                buffers = {'blurred_image': np.empty(frame.shape, dtype=blur_dtype) if blur_dtype else None,
+                           'coordinate_offsets': np.empty((2,) + frame.shape,
+                                                          dtype=np.float32 if order > 0 else int)}
+                maxima = None
+            self.image = frame
+            self._blurred_image = blur_backends.gaussian_blur(frame, self._blur_radius, backend=blur_backend,
+                                                              output=buffers['blurred_image'])
+            if track_maxima and maxima is not None:
+                self._local_maxima = [None, self.track_maxima(maxima, search_radius=search_radius)]
+            maxima = self.maxima
+            coordinate_offsets = self.dejitter_full_image(box_size=box_size, out=buffers['coordinate_offsets'])
+            yield self.apply_correction(coordinate_offsets, order=order, out=out[index] if out is not None else None)
+
+    def correct_channel(self, channel, box_size=60, order=0, out=None):
+        # Corrects "channel", another signal acquired in the same scan as self.image (e.g. MAADF for a HAADF image),
+        # with the offsets calculated from self.image. With an offset cache, the offsets of an image that was
+        # corrected before are not calculated again.
+        channel = np.asarray(channel)
+        if channel.shape != self.image.shape:
+            raise ValueError('Channel has shape {} but must have the shape of the image {}.'.format(channel.shape,
+                                                                                                  self.image.shape))
+        coordinate_offsets = self.dejitter_full_image(box_size=box_size, subpixel=order > 0)
+        dtype = channel.dtype if order == 0 else np.float32
+        with self.instrumentation.stage('apply_correction'):
+            return apply_correction_in_strips(channel, coordinate_offsets, _open_output(out, channel.shape, dtype),
+                                              order=order)
+
+    def correct_channels(self, channels, box_size=60, channel_axis=0, order=0, out=None):
+        # Like correct_channel for several channels at once: a (C, H, W) stack with channel_axis=0 or a spectrum image
+        # (H, W, E) with channel_axis=-1. All channels are gathered together (see apply_correction_in_strips) without
+        # a copy per channel. "out" can be a preallocated array of the shape of "channels".
+        channels = np.asarray(channels)
+        if channels.ndim != 3 or channel_axis not in (0, -1, 2):
+            raise ValueError('Channels must be of shape (C, H, W) with channel_axis=0 or (H, W, E) with '
+                             'channel_axis=-1.')
+        channels_last = np.moveaxis(channels, channel_axis, -1)
+        if channels_last.shape[:2] != self.image.shape:
+            raise ValueError('Channels have images of shape {} but must have the shape of the image {}.'.format(
+                                                                            channels_last.shape[:2], self.image.shape))
+        coordinate_offsets = self.dejitter_full_image(box_size=box_size, subpixel=order > 0)
+        dtype = channels.dtype if order == 0 else np.float32
+        out = _open_output(out, channels.shape, dtype)
+        with self.instrumentation.stage('apply_correction'):
+            apply_correction_in_strips(channels_last, coordinate_offsets, np.moveaxis(out, channel_axis, -1),
+                                       order=order)
+        return out
+
+    def apply_correction(self, coordinate_offsets, order=0, out=None):
+        # Returns the image corrected with "coordinate_offsets". "order" is the interpolation order along x (0, 1 or 3),
+        # the y-offsets always select whole rows. With order > 0 the result is float32. "out" can be a preallocated
+        # array for the result.
+        dtype = self.image.dtype if order == 0 else np.float32
+        with self.instrumentation.stage('apply_correction'):
+            return apply_correction_in_strips(self.image, coordinate_offsets,
+                                              _open_output(out, self.image.shape, dtype), order=order)
 
 def draw_circle(image, center, radius, color=-1, thickness=-1):
     subarray = image[center[0]-radius:center[0]+radius+1, center[1]-radius:center[1]+radius+1]
@@ -314,3 +834,426 @@ def draw_circle(image, center, radius, color=-1, thickness=-1):
         subarray[(distances < radius + np.sqrt(2)/2) * (distances > radius - np.sqrt(2)/2)] = color
     else:
         subarray[(distances < radius+thickness+1) * (distances > radius-thickness)] = color
+
+def draw_markers(image, maxima, size, color=-1):
+    # Draws a cross about "size" pixels wide at each of "maxima" (shape (N, 2)) into "image" without a loop over the
+    # maxima. Parts of the crosses outside of the image are left out.
+    maxima = np.array(maxima, dtype=np.intp).reshape(-1, 2)
+    half_size = int(np.rint(size/2))
+    offsets = np.arange(-half_size, half_size + 1)
+    rows = np.concatenate(((maxima[:, :1] + offsets).ravel(), np.repeat(maxima[:, 0], len(offsets))))
+    cols = np.concatenate((np.repeat(maxima[:, 1], len(offsets)), (maxima[:, 1:] + offsets).ravel()))
+    in_image = (rows >= 0) & (rows < image.shape[0]) & (cols >= 0) & (cols < image.shape[1])
+    image[rows[in_image], cols[in_image]] = color
+    return image
+
+def jitter_score(image):
+    # Ratio of the mean squared differences between neighbouring rows and between neighbouring columns. Jitter adds
+    # differences between rows, so lower values mean less visible jitter (about 1 for isotropic features).
+    image = np.asarray(image, dtype=np.float64)
+    return np.mean(np.square(np.diff(image, axis=0))) / np.mean(np.square(np.diff(image, axis=1)))
+
+def line_shifts(image, max_shift=16, smoothing=8, sigma=0, strip_height=512, cancel=None):
+    # Estimates the x-shift of each row of "image" (to be added to its x-coordinates, like the x-offsets). The shift
+    # between neighbouring rows is the position of the maximum of their cross-correlation, which is calculated for all
+    # rows of a strip at once via real FFTs (zero padded, so the correlation does not wrap around) and refined to
+    # sub-pixel precision with a parabola through the maximum. The positions of the rows are the cumulative sum of
+    # these shifts, of which only the part that changes within a few rows is jitter: a Gaussian with sigma
+    # "smoothing" (in rows) gives the slowly changing part, which is subtracted. With "sigma" the rows are blurred along
+    # x with a Gaussian first (done on the spectra). "cancel" is called for every strip.
+    image = np.asarray(image)
+    height, width = image.shape
+    max_shift = int(min(max_shift, width - 1))
+    length = fft.next_fast_len(2*width, real=True)
+    lags = np.arange(-max_shift, max_shift + 1)
+    # Both rows blurred with sigma, which multiplies the product of their spectra with the squared kernel spectrum
+    blur = np.exp(-4*(np.pi*sigma*fft.rfftfreq(length))**2).astype(np.float32)
+    steps = np.zeros(height)
+    for start in range(1, height, strip_height):
+        if cancel is not None:
+            cancel()
+        stop = min(start + strip_height, height)
+        rows = image[start - 1:stop].astype(np.float32)
+        rows -= np.mean(rows, axis=1, keepdims=True)
+        spectra = fft.rfft(rows, n=length, axis=1)
+        correlation = fft.irfft(np.conj(spectra[:-1]) * spectra[1:] * blur, n=length, axis=1)[:, lags]
+        peak = np.argmax(correlation, axis=1)
+        # Sub-pixel position of the maximum, not at the ends of the searched range
+        inner = np.clip(peak, 1, 2*max_shift - 1) if max_shift > 0 else peak
+        left, center, right = (correlation[np.arange(len(peak)), inner + offset] for offset in (-1, 0, 1))
+        curvature = left - 2*center + right
+        with np.errstate(divide='ignore', invalid='ignore'):
+            refinement = np.where((peak == inner) & (curvature < 0), 0.5*(left - right)/curvature, 0)
+        steps[start:stop] = lags[peak] + refinement
+    positions = np.cumsum(steps)
+    return positions - ndimage.gaussian_filter1d(positions, smoothing, mode='nearest')
+
+def apply_correction_in_strips(image, coordinate_offsets, out, strip_height=512, order=0):
+    # Implementation of Jitter.apply_correction. Only reads the rows of "image" and "coordinate_offsets" needed for one
+    # strip of "out" at a time, so all three can be memory mapped, and all temporary arrays are of strip size.
+    # Since the y-offsets select whole rows, interpolation is only done along x: linear for order 1 and with cubic
+    # splines (like ndimage.map_coordinates with mode='mirror') for order 3. Coordinates outside of the image are
+    # clipped to the border. "image" can have additional axes after (H, W), e.g. the energy axis of a spectrum image.
+    # These are gathered together with their pixel, so all channels are corrected in one indexing operation.
+    if order not in (0, 1, 3):
+        raise ValueError('Interpolation order must be 0, 1 or 3, not {}.'.format(order))
+    shape = image.shape
+    channel_shape = shape[2:]
+    # Keeps the temporary arrays of a strip at the same size as for a single channel
+    strip_height = max(1, strip_height // int(np.prod(channel_shape)))
+    for start in range(0, shape[0], strip_height):
+        stop = min(start + strip_height, shape[0])
+        rows = np.clip(np.arange(start, stop)[:, np.newaxis] + coordinate_offsets[0, start:stop], 0,
+                       shape[0] - 1).astype(np.intp)
+        cols = np.clip(np.arange(shape[1], dtype=np.float32) + coordinate_offsets[1, start:stop], 0, shape[1] - 1)
+        first_row = np.amin(rows)
+        block = image[first_row:np.amax(rows) + 1]
+        rows -= first_row
+        if order == 0:
+            out[start:stop] = block[rows, cols.astype(np.intp)]
+            continue
+        left = np.floor(cols)
+        fraction = (cols - left).astype(np.float32).reshape(cols.shape + (1,)*len(channel_shape))
+        left = left.astype(np.intp)
+        if order == 1:
+            right = np.minimum(left + 1, shape[1] - 1)
+            out[start:stop] = block[rows, left] * (1 - fraction) + block[rows, right] * fraction
+        else:
+            coefficients = ndimage.spline_filter1d(block, order=3, axis=1, output=np.float32)
+            weights = [(1 - fraction)**3 / 6,
+                       (4 - 6*fraction**2 + 3*fraction**3) / 6,
+                       (1 + 3*fraction + 3*fraction**2 - 3*fraction**3) / 6,
+                       fraction**3 / 6]
+            corrected = np.zeros(rows.shape + channel_shape, dtype=np.float32)
+            for offset, weight in zip(range(-1, 3), weights):
+                corrected += weight * coefficients[rows, _mirror_index(left + offset, shape[1])]
+            out[start:stop] = corrected
+    return out
+
+def make_box_mask(box_size):
+    # Mask of the pixels outside the circular box around a maximum (True means excluded from the correction)
+    half_box_size = int(box_size/2)
+    if box_size%2 == 0:
+        box_size = int(box_size + 1)
+    else:
+        box_size = int(box_size)
+    mask = np.ones((box_size, box_size), dtype=bool)
+    draw_circle(mask, (half_box_size, half_box_size), half_box_size, color=False)
+    return mask[:-1, :-1]
+
+def analyze_maxima_numpy(image, sorted_maxima, noise_tolerance, radius=4, max_elements=2**22):
+    # NumPy version of the flood fill in AnalyzeMaxima.analyze_maxima. "sorted_maxima" are flat indices into "image",
+    # brightest first. Returns the flat indices of the maxima that stand out by more than "noise_tolerance", in the
+    # same order. A maximum with value v is kept if the region of pixels >= v - noise_tolerance connected to it
+    # (8-neighbours) contains no brighter pixel and no maximum of the same value that comes before it, which is the
+    # result of the flood fill.
+    sorted_maxima = np.asarray(sorted_maxima, dtype=np.intp)
+    status, region_keys = _maxima_regions(image, sorted_maxima, noise_tolerance, radius=radius,
+                                          max_elements=max_elements)
+    kept = np.flatnonzero(status == 1)
+    return sorted_maxima[kept[_first_in_region(region_keys[kept])]]
+
+def _maxima_regions(image, maxima, noise_tolerance, open_edges=(False,)*4, radius=4, max_elements=2**22):
+    # Region of pixels >= v - noise_tolerance connected to each of "maxima" (flat indices into "image", v is the
+    # value of the maximum). Returns the status of each maximum (1: no brighter pixel in the region, 0: a brighter
+    # pixel, -1: no brighter pixel, but the region reaches an edge of "image" that is marked as open in "open_edges"
+    # (top, bottom, left, right), so it can continue outside) and the smallest flat index in each region, which
+    # identifies it. The regions of all maxima are labeled at once in windows around them. Windows in which the
+    # region reaches the window border without containing a brighter pixel are enlarged until the region fits.
+    image = np.asarray(image)
+    shape = image.shape
+    maxima = np.asarray(maxima, dtype=np.intp)
+    values = image.ravel()[maxima]
+    thresholds = values.astype(np.float64) - noise_tolerance
+    maxima_rows, maxima_cols = np.divmod(maxima, shape[1])
+    status = np.zeros(len(maxima), dtype=np.int8)
+    region_keys = np.zeros(len(maxima), dtype=np.intp)
+    # Label each window separately with 8-connectivity
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = True
+    pending = np.arange(len(maxima))
+    while len(pending) > 0:
+        size = 2*radius + 1
+        border = np.ones((size, size), dtype=bool)
+        border[1:-1, 1:-1] = False
+        still_open = []
+        for batch in _box_batches(len(pending), (size, size), max_elements):
+            indices = pending[batch]
+            rows = maxima_rows[indices, np.newaxis] + np.arange(-radius, radius + 1)
+            cols = maxima_cols[indices, np.newaxis] + np.arange(-radius, radius + 1)
+            inside = (((rows >= 0) & (rows < shape[0]))[:, :, np.newaxis] &
+                      ((cols >= 0) & (cols < shape[1]))[:, np.newaxis, :])
+            rows = np.clip(rows, 0, shape[0] - 1)[:, :, np.newaxis]
+            cols = np.clip(cols, 0, shape[1] - 1)[:, np.newaxis, :]
+            window = image[rows, cols]
+            labels = ndimage.label(inside & (window >= thresholds[indices, np.newaxis, np.newaxis]), structure)[0]
+            region = labels == labels[:, radius, radius, np.newaxis, np.newaxis]
+            brighter = np.any(region & (window > values[indices, np.newaxis, np.newaxis]), axis=(1, 2))
+            is_open = ~brighter & np.any(region & border, axis=(1, 2))
+            done = ~is_open
+            region = region[done]
+            at_open_edge = np.zeros(region.shape, dtype=bool)
+            for edge, is_at_edge in zip(open_edges, (rows[done] == 0, rows[done] == shape[0] - 1, cols[done] == 0,
+                                                     cols[done] == shape[1] - 1)):
+                if edge:
+                    at_open_edge |= is_at_edge
+            status[indices[done]] = np.where(brighter[done], 0, np.where(np.any(region & at_open_edge, axis=(1, 2)),
+                                                                         -1, 1))
+            region_keys[indices[done]] = np.amin(np.where(region, rows[done]*shape[1] + cols[done], image.size),
+                                                 axis=(1, 2))
+            still_open.append(indices[is_open])
+        pending = np.concatenate(still_open)
+        radius *= 2
+    return status, region_keys
+
+def _first_in_region(region_keys):
+    # Indices of the first maximum in each region, in their original order. A kept maximum can only share its region
+    # with kept maxima of the same value, of which the first one wins in the flood fill.
+    return np.sort(np.unique(region_keys, return_index=True)[1])
+
+def extract_boxes(image, corners, box_shape):
+    # Gathers the boxes with upper left corners "corners" (shape (N, 2)) into one array of shape (N,) + box_shape
+    image = np.asarray(image)
+    windows = np.lib.stride_tricks.as_strided(image,
+                                              shape=(image.shape[0] - box_shape[0] + 1,
+                                                     image.shape[1] - box_shape[1] + 1) + tuple(box_shape),
+                                              strides=image.strides*2, writeable=False)
+    return windows[corners[:, 0], corners[:, 1]]
+
+def extract_y_corrected_boxes(image, y_offsets, corners, box_shape):
+    # Same as extract_boxes(y-corrected image, corners, box_shape), where the y-corrected image is "image" corrected
+    # with "y_offsets" (and no x-offsets) like in apply_correction
+    image = np.asarray(image)
+    box_rows = corners[:, 0, np.newaxis, np.newaxis] + np.arange(box_shape[0])[:, np.newaxis]
+    rows = np.clip(box_rows + extract_boxes(y_offsets, corners, box_shape), 0, image.shape[0] - 1).astype(np.intp)
+    cols = corners[:, 1, np.newaxis, np.newaxis] + np.arange(box_shape[1])
+    return image[rows, cols]
+
+def y_corrected_minimum(image, y_offsets, strip_height=512):
+    # Minimum of the y-corrected image (see extract_y_corrected_boxes), calculated in strips
+    minimum = None
+    for start in range(0, image.shape[0], strip_height):
+        stop = min(start + strip_height, image.shape[0])
+        rows = np.clip(np.arange(start, stop)[:, np.newaxis] + y_offsets[start:stop], 0,
+                       image.shape[0] - 1).astype(np.intp)
+        first_row = np.amin(rows)
+        strip_minimum = np.amin(image[first_row:np.amax(rows) + 1][rows - first_row, np.arange(image.shape[1])])
+        minimum = strip_minimum if minimum is None else min(minimum, strip_minimum)
+    return minimum
+
+def box_corners(maxima, shape, half_box_size):
+    # Upper left corners of the boxes around "maxima". Boxes too close to the border are not corrected.
+    maxima = np.array(maxima, dtype=np.intp).reshape(-1, 2)
+    in_image = np.all((maxima >= half_box_size) & (maxima < np.array(shape) - half_box_size - 1), axis=1)
+    return maxima[in_image] - half_box_size
+
+def box_owner_map(shape, corners, box_shape, overlap='last'):
+    # For each pixel the index of the box in "corners" that corrects it, -1 for pixels outside all boxes. Where boxes
+    # overlap, "overlap" decides: 'last' takes the last box in "corners" that contains the pixel, 'nearest' the box
+    # whose maximum (the box center) is closest (a Voronoi partition, from the indices of a distance transform).
+    # Pixels whose nearest maximum is too far away for its box to contain them fall back to 'last'.
+    if overlap not in ('last', 'nearest'):
+        raise ValueError('Unknown overlap mode "{}". Possible values are: last, nearest.'.format(overlap))
+    box_indices = np.full(shape, -1, dtype=np.int32)
+    if len(corners) == 0:
+        return box_indices
+    np.maximum.at(box_indices, (corners[:, 0], corners[:, 1]), np.arange(len(corners), dtype=np.int32))
+    box_indices = ndimage.maximum_filter(box_indices, size=box_shape, mode='constant', cval=-1,
+                                         origin=((box_shape[0]-1)//2, (box_shape[1]-1)//2))
+    if overlap == 'last':
+        return box_indices
+    centers = corners + np.array(box_shape)//2
+    center_indices = np.full(shape, -1, dtype=np.int32)
+    center_indices[centers[:, 0], centers[:, 1]] = np.arange(len(corners), dtype=np.int32)
+    nearest_center = ndimage.distance_transform_edt(center_indices < 0, return_distances=False, return_indices=True)
+    nearest = center_indices[nearest_center[0], nearest_center[1]]
+    del nearest_center
+    box_rows = np.arange(shape[0])[:, np.newaxis] - corners[nearest, 0]
+    box_cols = np.arange(shape[1]) - corners[nearest, 1]
+    in_box = (box_rows >= 0) & (box_rows < box_shape[0]) & (box_cols >= 0) & (box_cols < box_shape[1])
+    return np.where(in_box, nearest, box_indices)
+
+def tile_halo(box_size, sigma, truncate=4.0):
+    # Halo around a tile so that all maxima whose boxes reach into the tile (including the y-corrected pixels the
+    # x-correction reads) and the blurred image around them are the same as for the full image
+    return 3*int(box_size/2) + 2 + int(truncate*np.amax(sigma) + 0.5)
+
+def _tiles(shape, tile, halo):
+    # Core and padded slices of all tiles
+    for y in range(0, shape[0], tile[0]):
+        for x in range(0, shape[1], tile[1]):
+            core = (slice(y, min(y + tile[0], shape[0])), slice(x, min(x + tile[1], shape[1])))
+            padded = (slice(max(y - halo, 0), min(y + tile[0] + halo, shape[0])),
+                      slice(max(x - halo, 0), min(x + tile[1] + halo, shape[1])))
+            yield core, padded
+
+def _bounded_map(executor, function, *iterables, window=8):
+    # Like executor.map, but only submits "window" tasks ahead, so that the arguments of all tasks do not have to be
+    # in memory at the same time
+    pending = collections.deque()
+    for arguments in zip(*iterables):
+        if len(pending) >= window:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, *arguments))
+    while pending:
+        yield pending.popleft().result()
+
+def _mirror_index(index, size):
+    # Mirrors indices outside of [0, size - 1] at the border pixels (like mode='mirror' in ndimage)
+    if size == 1:
+        return np.zeros_like(index)
+    index = np.abs(index)
+    return np.where(index > size - 1, 2*(size - 1) - index, index)
+
+def _open_output(output, shape, dtype):
+    if output is None:
+        return np.empty(shape, dtype=dtype)
+    if isinstance(output, str):
+        return np.lib.format.open_memmap(output, mode='w+', dtype=dtype, shape=shape)
+    if output.shape != tuple(shape):
+        raise ValueError('Output has shape {} but must have shape {}.'.format(output.shape, tuple(shape)))
+    return output
+
+def _core_in_tile(core, padded):
+    return (slice(core[0].start - padded[0].start, core[0].stop - padded[0].start),
+            slice(core[1].start - padded[1].start, core[1].stop - padded[1].start))
+
+def _boxes_touching(corners, box_shape, region):
+    # Boxes that overlap with "region" (tuple of slices)
+    return corners[np.all((corners + np.array(box_shape) > (region[0].start, region[1].start)) &
+                          (corners < (region[0].stop, region[1].stop)), axis=1)]
+
+def _tile_boxes(corners, box_shape, core, padded, overlap):
+    # Boxes that are needed to correct the core of a tile. With overlap='nearest' the nearest maximum of a pixel can
+    # belong to a box that does not reach into the core, so all boxes inside the padded tile are used.
+    if overlap == 'last':
+        return _boxes_touching(corners, box_shape, core)
+    return corners[np.all((corners >= (padded[0].start, padded[1].start)) &
+                          (corners + np.array(box_shape) <= (padded[0].stop, padded[1].stop)), axis=1)]
+
+def _tile_maxima(image_tile, tile_slices, image_shape, sigma, noise_tolerance, blur_backend, candidates=None):
+    # First round of dejitter_tiled: maxima in the core of one tile. The flood fill of analyze_and_mark_maxima is
+    # decided in the part of the tile in which the blurred image is the same as for the full image (the tile without
+    # the blur radius at borders inside the image). Maxima whose region reaches one of these borders can continue in
+    # the neighbouring tiles, so they are returned with status -1 and checked again in a larger tile (see
+    # Jitter._tiled_maxima). "candidates" are the maxima to check (image coordinates), by default all local maxima in
+    # the core. Returns the maxima that are not rejected (image coordinates), their status (1 or -1), their blurred
+    # values and the keys of their regions (see _maxima_regions) as flat indices into the image.
+    # The 'fft' and 'recursive' backends do not give bit-identical results for a part of the image, so with these
+    # the result can differ from dejitter_full_image for maxima with almost the same value.
+    core, padded = tile_slices
+    origin = np.array((padded[0].start, padded[1].start))
+    jitter = Jitter(blur_backend=blur_backend)
+    jitter.image = image_tile
+    jitter.blur_radius = sigma
+    if candidates is None:
+        candidates = jitter.raw_local_maxima[1] + origin
+        candidates = candidates[np.all((candidates >= (core[0].start, core[1].start)) &
+                                       (candidates < (core[0].stop, core[1].stop)), axis=1)]
+    blur_radius = int(4.0*np.amax(sigma) + 0.5)
+    open_edges = (padded[0].start > 0, padded[0].stop < image_shape[0], padded[1].start > 0,
+                  padded[1].stop < image_shape[1])
+    valid = (slice(blur_radius*open_edges[0], image_tile.shape[0] - blur_radius*open_edges[1]),
+             slice(blur_radius*open_edges[2], image_tile.shape[1] - blur_radius*open_edges[3]))
+    valid_origin = origin + (valid[0].start, valid[1].start)
+    valid_image = jitter.blurred_image[valid].astype(np.float32)
+    local_maxima = candidates - valid_origin
+    status, region_keys = _maxima_regions(valid_image, local_maxima[:, 0]*valid_image.shape[1] + local_maxima[:, 1],
+                                          noise_tolerance, open_edges=open_edges)
+    key_rows, key_cols = np.divmod(region_keys, valid_image.shape[1])
+    region_keys = (key_rows + valid_origin[0])*image_shape[1] + key_cols + valid_origin[1]
+    values = jitter.blurred_image[candidates[:, 0] - origin[0], candidates[:, 1] - origin[1]]
+    not_rejected = status != 0
+    return candidates[not_rejected], status[not_rejected], values[not_rejected], region_keys[not_rejected]
+
+def _tile_y_jitter(image_tile, corners, tile_slices, box_size, overlap='last', kernel_backend=kernels.DEFAULT_BACKEND):
+    # Second round of dejitter_tiled: y-correction of one tile with the boxes of the full image that reach into its
+    # core. Returns the y-offsets in the core and the minimum of the y-corrected core.
+    core = _core_in_tile(*tile_slices)
+    origin = np.array((tile_slices[1][0].start, tile_slices[1][1].start))
+    mask = make_box_mask(box_size)
+    corners = corners - origin
+    owners = box_owner_map(image_tile.shape, corners, mask.shape, overlap=overlap)
+    y_offsets = np.zeros(image_tile.shape, dtype=int)
+    Jitter(kernel_backend=kernel_backend).correct_y_jitter(image_tile, corners, owners, mask, y_offsets)
+    y_corrected = np.take_along_axis(image_tile[:, core[1]], np.arange(image_tile.shape[0])[core[0], np.newaxis] +
+                                     y_offsets[core], axis=0)
+    return y_offsets[core], np.amin(y_corrected)
+
+def _tile_x_jitter(image_tile, y_offsets, corners, tile_slices, minimum, box_size, dtype, overlap='last',
+                   kernel_backend=kernels.DEFAULT_BACKEND):
+    # Third round of dejitter_tiled: x-correction of one tile with the boxes of the full image that reach into
+    # its core and the global y-offsets. Returns the x-offsets in the core.
+    core = _core_in_tile(*tile_slices)
+    origin = np.array((tile_slices[1][0].start, tile_slices[1][1].start))
+    mask = make_box_mask(box_size)
+    corners = corners - origin
+    owners = box_owner_map(image_tile.shape, corners, mask.shape, overlap=overlap)
+    # Pixels close to the tile border can point outside of the tile, but these are not used for the core
+    rows = np.clip(np.arange(image_tile.shape[0])[:, np.newaxis] + y_offsets.astype(np.intp), 0,
+                   image_tile.shape[0] - 1)
+    y_corrected = np.take_along_axis(image_tile, rows, axis=0)
+    y_corrected -= minimum
+    x_offsets = np.zeros(image_tile.shape, dtype=dtype)
+    Jitter(kernel_backend=kernel_backend).correct_x_jitter(y_corrected, corners, owners, mask, x_offsets)
+    return x_offsets[core]
+
+def _masked_row_means(crop_stack, mask):
+    # Row means along the last axis that match np.ma.mean for a masked array bit by bit
+    if mask is None:
+        return np.mean(crop_stack, axis=-1)
+    if crop_stack.dtype == np.float16:
+        # How np.ma sums and divides float16 values depends on the NumPy version, so it is used directly for this
+        # rarely used type
+        return np.ma.getdata(np.mean(np.ma.masked_array(crop_stack, mask=np.broadcast_to(mask, crop_stack.shape)),
+                                     axis=-1))
+    dtype = None
+    if issubclass(crop_stack.dtype.type, (np.integer, np.bool_)):
+        dtype = np.float64
+    row_sums = np.sum(np.where(mask, crop_stack.dtype.type(0), crop_stack), axis=-1, dtype=dtype)
+    return row_sums * 1. / np.sum(~mask, axis=-1)
+
+def _row_sources(row_means):
+    # Row each box row is taken from: the upper half of the box is sorted by ascending, the lower half by descending
+    # row mean (see remove_y_jitter_batch)
+    half_height = int(row_means.shape[1]/2)
+    row_sources = np.empty(row_means.shape, dtype=np.intp)
+    row_sources[:, :half_height] = np.argsort(row_means[:, :half_height], axis=-1)
+    row_sources[:, half_height:] = np.argsort(row_means[:, half_height:], axis=-1)[:, ::-1] + half_height
+    return row_sources
+
+def _row_shifts(weighted_sum, total_sum, width):
+    # Shift of each box row from the sums along the rows (see remove_x_jitter_com_batch)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        com_lines = weighted_sum/total_sum
+        # Same rules as the domain of np.ma.true_divide, so that results are identical to remove_x_jitter_com
+        valid = np.isfinite(com_lines) & ~(np.abs(weighted_sum) * np.finfo(float).tiny >= np.abs(total_sum))
+        com_lines = np.where(valid, com_lines - width/2, 0)
+        mean_com = np.sum(com_lines, axis=-1) * 1. / np.sum(valid, axis=-1)
+    return np.where(valid, com_lines - np.expand_dims(mean_com, axis=-1), 0)
+
+@functools.lru_cache(maxsize=1)
+def _analyze_maxima_extension():
+    # AnalyzeMaxima is imported on first use, so that importing this module (e.g. when Swift loads the plugin) does not
+    # fail or get slower if the extension is missing or broken. Without it, analyze_maxima_numpy is used.
+    try:
+        from AnalyzeMaxima import analyze_maxima
+    except ImportError as error:
+        logging.warning('Could not import AnalyzeMaxima ({}). Using the NumPy version instead.'.format(error))
+        return None
+    return analyze_maxima
+
+def _box_batches(number_boxes, box_shape, max_elements=2**22):
+    # Slices of box indices so that a stack of boxes stays below "max_elements"
+    batch_size = max(1, max_elements//(box_shape[0]*box_shape[1]))
+    for start in range(0, number_boxes, batch_size):
+        yield slice(start, min(start + batch_size, number_boxes))
+
+def _owned_pixels(owners, corners, max_elements=2**22):
+    # Yields the pixels that belong to a box in row strips together with the box index and the position in the box
+    strip_height = max(1, max_elements//max(owners.shape[1], 1))
+    for start in range(0, owners.shape[0], strip_height):
+        rows, cols = np.nonzero(owners[start:start+strip_height] >= 0)
+        rows += start
+        box_index = owners[rows, cols]
+        yield rows, cols, box_index, rows - corners[box_index, 0], cols - corners[box_index, 1]
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Timing, memory and counter instrumentation for the stages of the jitter correction.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+import tracemalloc
+
+class Instrumentation(object):
+    # Collects the run time (and with "track_memory" the peak memory allocated, measured with tracemalloc) of named
+    # stages and the values of counters. Events are passed to "callback" as callback(event_type, name, value) with
+    # event_type one of 'stage_started' (value None), 'stage_finished' (value is the stage record of this call),
+    # 'counter' (value is the new total) and 'message' (name is the text, value None). They are also logged to
+    # "logger" if given. Without callback and logger, messages are printed like before.
+
+    def __init__(self, callback=None, logger=None, track_memory=False):
+        self.callback = callback
+        self.logger = logger
+        self.track_memory = track_memory
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._memory_stack = []
+        self._started_tracing = False
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.counters.clear()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        # Times the code in the with-block and adds the result to stages[name]. Stages can be nested, but with
+        # "track_memory" only one thread should run stages at a time because tracemalloc is global.
+        self._emit('stage_started', name, None)
+        if self.track_memory:
+            self._start_memory_tracking()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            peak_memory = self._stop_memory_tracking() if self.track_memory else None
+            with self._lock:
+                record = self.stages.setdefault(name, {'time': 0.0, 'calls': 0, 'peak_memory': None})
+                record['time'] += elapsed
+                record['calls'] += 1
+                if peak_memory is not None:
+                    record['peak_memory'] = max(record['peak_memory'] or 0, peak_memory)
+            self._emit('stage_finished', name, {'time': elapsed, 'peak_memory': peak_memory})
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            total = self.counters[name]
+        self._emit('counter', name, total)
+
+    def message(self, text):
+        if self.callback is None and self.logger is None:
+            print(text)
+        else:
+            self._emit('message', text, None)
+
+    def report(self):
+        # Per-stage breakdown and counters as text
+        lines = []
+        with self._lock:
+            total_time = sum(record['time'] for record in self.stages.values())
+            for name, record in self.stages.items():
+                line = '{}: {:.3f} s'.format(name, record['time'])
+                if record['calls'] > 1:
+                    line += ' ({:.0f} calls)'.format(record['calls'])
+                if record['peak_memory'] is not None:
+                    line += ', {:.1f} MB'.format(record['peak_memory']/1e6)
+                lines.append(line)
+            if self.stages:
+                lines.append('total: {:.3f} s'.format(total_time))
+            for name, value in self.counters.items():
+                lines.append('{}: {:.0f}'.format(name.replace('_', ' '), value))
+        return '\n'.join(lines)
+
+    def _emit(self, event_type, name, value):
+        if self.logger is not None:
+            if event_type == 'message':
+                self.logger.info(name)
+            elif event_type == 'stage_finished':
+                self.logger.debug('{} took {:.3f} s'.format(name, value['time']))
+        if self.callback is not None:
+            self.callback(event_type, name, value)
+
+    def _start_memory_tracking(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        current, peak = tracemalloc.get_traced_memory()
+        if self._memory_stack:
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], peak)
+        # Without reset_peak (Python < 3.9) the peak includes everything since tracing started
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self._memory_stack.append([current, current])
+
+    def _stop_memory_tracking(self):
+        current, peak = tracemalloc.get_traced_memory()
+        start, stage_peak = self._memory_stack.pop()
+        stage_peak = max(stage_peak, peak)
+        if self._memory_stack:
+            self._memory_stack[-1][1] = max(self._memory_stack[-1][1], stage_peak)
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        elif self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+        return stage_peak - start
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Optional Numba kernels for the per-box loops of the jitter correction. They are used by Jitter if Numba is installed,
+otherwise the NumPy code in correct_jitter runs. The kernels themselves are in numba_kernels.py.
+"""
+
+import functools
+import importlib.util
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+# Backends that can be passed to Jitter(kernel_backend=...). The default is chosen once on import, but without
+# importing Numba, which takes a while (e.g. when Swift loads the plugin). Numba is imported when the first kernel runs.
+KERNEL_BACKENDS = ('numpy', 'numba')
+DEFAULT_BACKEND = 'numba' if importlib.util.find_spec('numba') is not None else 'numpy'
+# Image types the kernels are compiled for. Other types (e.g. float16) always use the NumPy code.
+SUPPORTED_DTYPES = tuple(np.dtype(dtype) for dtype in (np.uint8, np.uint16, np.uint32, np.int8, np.int16, np.int32,
+                                                        np.int64, np.float32, np.float64))
+
+def check_backend(backend):
+    if backend not in KERNEL_BACKENDS:
+        raise ValueError('Unknown kernel backend "{}". Possible values are: {}.'.format(backend,
+                                                                                     ', '.join(KERNEL_BACKENDS)))
+    if backend == 'numba' and importlib.util.find_spec('numba') is None:
+        raise ValueError('The kernel backend "numba" needs Numba to be installed.')
+    return backend
+
+def supports(image):
+    # Is called before the kernels run, so this is where Numba is imported
+    return np.asarray(image).dtype in SUPPORTED_DTYPES and _numba_kernels() is not None
+
+# The sums run in float64 for all image types. This is exact for integer images, so the results are identical to the
+# NumPy code. For float images they can differ from it by rounding, because NumPy uses pairwise summation.
+
+def box_row_means(image, corners, mask):
+    # Means of the unmasked pixels in each row of the boxes with upper left corners "corners", shape (N, box_height).
+    # Same as correct_jitter._masked_row_means(extract_boxes(image, corners, mask.shape), mask).
+    row_means = np.empty((len(corners), mask.shape[0]))
+    _run_in_chunks(_numba_kernels().box_row_means, len(corners), np.ascontiguousarray(image),
+                   np.ascontiguousarray(corners, dtype=np.intp), mask, row_means)
+    return row_means
+
+def box_row_sums(image, corners, mask, y_offsets=None, minimum=0):
+    # Sum and column-weighted sum of the unmasked pixels in each row of the boxes, both of shape (N, box_height). The
+    # minimum is subtracted from all pixels. With "y_offsets" the boxes are taken from "image" corrected with them
+    # (see correct_jitter.extract_y_corrected_boxes).
+    image = np.ascontiguousarray(image)
+    weighted_sums = np.empty((len(corners), mask.shape[0]))
+    total_sums = np.empty((len(corners), mask.shape[0]))
+    if y_offsets is None:
+        y_offsets = np.zeros((0, 0), dtype=np.intp)
+        use_y_offsets = False
+    else:
+        use_y_offsets = True
+    _run_in_chunks(_numba_kernels().box_row_sums, len(corners), image, np.ascontiguousarray(corners, dtype=np.intp),
+                   mask, y_offsets, use_y_offsets, image.dtype.type(minimum), weighted_sums, total_sums)
+    return weighted_sums, total_sums
+
+def write_y_offsets(row_sources, corners, owners, mask, y_offsets):
+    # Writes the row offsets of all pixels owned by a box into "y_offsets" (see Jitter.correct_y_jitter)
+    _run_in_chunks(_numba_kernels().write_y_offsets, len(corners), row_sources,
+                   np.ascontiguousarray(corners, dtype=np.intp), owners, mask, y_offsets)
+
+def write_x_offsets(row_shifts, corners, owners, mask, x_offsets):
+    # Writes the column offsets of all pixels owned by a box into "x_offsets" (see Jitter.correct_x_jitter). Integer
+    # offsets are truncated like in the NumPy code.
+    _run_in_chunks(_numba_kernels().write_x_offsets, len(corners), row_shifts,
+                   np.ascontiguousarray(corners, dtype=np.intp), owners, mask, x_offsets,
+                   np.issubdtype(x_offsets.dtype, np.integer))
+
+def _run_in_chunks(kernel, number_boxes, *args):
+    # Calls kernel(*args, start, stop) for chunks of the boxes in a thread pool (the kernels release the GIL)
+    workers = min(os.cpu_count() or 1, max(number_boxes, 1))
+    chunk_size = -(-number_boxes // workers)
+    chunks = [(start, min(start + chunk_size, number_boxes)) for start in range(0, number_boxes, chunk_size or 1)]
+    if len(chunks) <= 1:
+        kernel(*(args + (0, number_boxes)))
+        return
+    with ThreadPoolExecutor(max_workers=len(chunks)) as executor:
+        for future in [executor.submit(kernel, *(args + chunk)) for chunk in chunks]:
+            future.result()
+
+@functools.lru_cache(maxsize=1)
+def _numba_kernels():
+    # Imports the kernels (and Numba) on first use. Returns None if Numba is installed but cannot be imported.
+    try:
+        from . import numba_kernels
+    except ImportError as error:
+        logging.warning('Could not import Numba ({}). Using the NumPy version instead.'.format(error))
+        return None
+    return numba_kernels
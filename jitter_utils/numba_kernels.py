@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Numba versions of the per-box loops, see kernels.py. Importing this module imports Numba, so it is only imported when
+the first kernel runs.
+"""
+
+import numba
+
+# Compiled on first use (and cached on disk). The boxes are distributed over a thread pool by kernels._run_in_chunks
+# instead of numba.prange: Numba's threading layers do not all work together with the process pools of dejitter_tiled
+# and the batch tool (fork) and the threads of sweep. Each pixel has only one owner, so the writes of different boxes
+# never collide.
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def box_row_means(image, corners, mask, row_means, start, stop):
+    for i in range(start, stop):
+        for row in range(mask.shape[0]):
+            row_sum = 0.0
+            count = 0
+            for col in range(mask.shape[1]):
+                if not mask[row, col]:
+                    row_sum += image[corners[i, 0] + row, corners[i, 1] + col]
+                    count += 1
+            row_means[i, row] = row_sum / count
+
+@numba.njit(nogil=True, cache=True, error_model='numpy')
+def box_row_sums(image, corners, mask, y_offsets, use_y_offsets, minimum, weighted_sums, total_sums, start, stop):
+    for i in range(start, stop):
+        for row in range(mask.shape[0]):
+            weighted_sum = 0.0
+            total_sum = 0.0
+            image_row = corners[i, 0] + row
+            for col in range(mask.shape[1]):
+                if mask[row, col]:
+                    continue
+                image_col = corners[i, 1] + col
+                source_row = image_row
+                if use_y_offsets:
+                    source_row = min(max(image_row + int(y_offsets[image_row, image_col]), 0), image.shape[0] - 1)
+                value = image[source_row, image_col] - minimum
+                weighted_sum += col * value
+                total_sum += value
+            weighted_sums[i, row] = weighted_sum
+            total_sums[i, row] = total_sum
+
+@numba.njit(nogil=True, cache=True)
+def write_y_offsets(row_sources, corners, owners, mask, y_offsets, start, stop):
+    for i in range(start, stop):
+        for row in range(mask.shape[0]):
+            for col in range(mask.shape[1]):
+                if owners[corners[i, 0] + row, corners[i, 1] + col] != i:
+                    continue
+                new_row = row if mask[row, col] else row_sources[i, row]
+                y_offsets[corners[i, 0] + row, corners[i, 1] + col] = new_row - row
+
+@numba.njit(nogil=True, cache=True)
+def write_x_offsets(row_shifts, corners, owners, mask, x_offsets, truncate, start, stop):
+    for i in range(start, stop):
+        for row in range(mask.shape[0]):
+            for col in range(mask.shape[1]):
+                image_col = corners[i, 1] + col
+                if owners[corners[i, 0] + row, image_col] != i:
+                    continue
+                new_col = float(col) if mask[row, col] else col + row_shifts[i, row]
+                new_col = corners[i, 1] + new_col
+                if truncate:
+                    new_col = float(int(new_col))
+                x_offsets[corners[i, 0] + row, image_col] = new_col - image_col
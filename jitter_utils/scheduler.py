@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Background job scheduler where newer jobs supersede older ones, used to keep the Nion Swift panel responsive.
+"""
+
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from .correct_jitter import DejitterCancelled
+
+class JobScheduler(object):
+    # Runs jobs in a worker pool. Submitting a job cancels the job that is waiting or running, so only the newest one
+    # finishes. A job is a function that is called with a threading.Event, which is set once the job is superseded.
+    # It should pass the event on as Jitter.cancel_event (or check it itself) and is stopped by DejitterCancelled.
+    # Jobs submitted with a delay only start if no newer job was submitted during the delay (debouncing).
+    # There is one worker by default because the jobs of the panel share one Jitter object and its cached results.
+
+    def __init__(self, max_workers=1, on_error=None):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._cancel_event = None
+        self._timer = None
+        # Called with the exception if a job fails, by default the exception is logged
+        self.on_error = on_error
+
+    def submit(self, job, delay=0):
+        with self._lock:
+            self._cancel_pending()
+            cancel_event = threading.Event()
+            self._cancel_event = cancel_event
+            if delay > 0:
+                self._timer = threading.Timer(delay, self._start, args=(job, cancel_event))
+                self._timer.daemon = True
+                self._timer.start()
+            else:
+                self._start(job, cancel_event)
+        return cancel_event
+
+    def cancel(self):
+        with self._lock:
+            self._cancel_pending()
+
+    def close(self):
+        self.cancel()
+        self._executor.shutdown(wait=False)
+
+    def _cancel_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._cancel_event is not None:
+            self._cancel_event.set()
+
+    def _start(self, job, cancel_event):
+        if not cancel_event.is_set():
+            self._executor.submit(self._run, job, cancel_event)
+
+    def _run(self, job, cancel_event):
+        # Jobs that were superseded while waiting for a free worker are skipped
+        if cancel_event.is_set():
+            return
+        try:
+            job(cancel_event)
+        except DejitterCancelled:
+            pass
+        except Exception as exception:
+            if self.on_error is not None:
+                self.on_error(exception)
+            else:
+                logging.exception('Jitter correction job failed')
@@ -1,8 +1,10 @@
 # standard libraries
 import gettext
+from jitter_utils import caching
 from jitter_utils import correct_jitter
+from jitter_utils import instrumentation
+from jitter_utils import scheduler
 import copy
-import threading
 import logging
 import numpy as np
 
@@ -20,55 +22,103 @@ class JitterPanelDelegate(object):
         self.box_size_field = None
         self.find_maxima_button = None
         self.correct_jitter_button = None
+        self.preview_check_box = None
+        self.status_label = None
         self.sigma = 5
         self.noise_tolerance = 1
         self.box_size = 60
+        # For a (C, H, W) stack or a (H, W, E) spectrum image the offsets are calculated from this channel (the sum of
+        # all channels if negative) and then applied to all channels
+        self.reference_channel = -1
+        self.reference = None
         self.source_data_item = None
         self.processed_data_item = None
         self.dejittered_data_item = None
-        self.Jitter = correct_jitter.Jitter()
-        self.t = None
+        self.preview_data_item = None
+        # In preview mode parameter changes only correct a rectangle region drawn on the source data item (or a
+        # "preview_size" square in its center)
+        self.preview_enabled = False
+        self.preview_size = 512
+        # Progress and the per-stage timings of the running job are shown in the panel
+        self.instrumentation = instrumentation.Instrumentation(callback=self.instrumentation_event)
+        # Offsets are kept on disk, so correcting an image again (also in a later session) does not recalculate them
+        self.Jitter = correct_jitter.Jitter(instrumentation=self.instrumentation, offset_cache=caching.OffsetCache())
+        self.progress = ''
+        # Jobs run in the background, a new job cancels the running one. Parameter changes re-run the last job after
+        # "debounce_delay" seconds without further changes.
+        self.scheduler = scheduler.JobScheduler()
+        self.debounce_delay = 0.5
+        self.last_job = None
     
     def create_panel_widget(self, ui, document_controller):
         self.document_controller = document_controller
         
         def sigma_finished(text):
             if len(text) > 0:
+                old_value = self.sigma
                 try:
                     self.sigma = float(text)
                 except ValueError:
                     pass
                 finally:
                     self.sigma_field.text = str(self.sigma)
+                if self.sigma != old_value:
+                    parameters_changed()
         
         def noise_tolerance_finished(text):
             if len(text) > 0:
+                old_value = self.noise_tolerance
                 try:
                     self.noise_tolerance = float(text)
                 except ValueError:
                     pass
                 finally:
                     self.noise_tolerance_field.text = str(self.noise_tolerance)
+                if self.noise_tolerance != old_value:
+                    parameters_changed()
+        
+        def reference_channel_finished(text):
+            if len(text) > 0:
+                old_value = self.reference_channel
+                try:
+                    self.reference_channel = int(text)
+                except ValueError:
+                    pass
+                finally:
+                    self.reference_channel_field.text = str(self.reference_channel)
+                if self.reference_channel != old_value:
+                    parameters_changed()
         
         def box_size_finished(text):
             if len(text) > 0:
+                old_value = self.box_size
                 try:
                     self.box_size = float(text)
                 except ValueError:
                     pass
                 finally:
                     self.box_size_field.text = str(self.box_size)
+                if self.box_size != old_value:
+                    parameters_changed()
+        
+        def parameters_changed():
+            if self.preview_enabled:
+                self.preview(delay=self.debounce_delay)
+            elif self.last_job is not None:
+                self.last_job(delay=self.debounce_delay)
+        
+        def preview_changed(checked):
+            self.preview_enabled = checked
+            if checked:
+                self.get_source_data_item()
+                self.preview()
         
         def find_maxima_clicked():
             self.get_source_data_item()
-            self.Jitter.blur_radius = self.sigma
-            self.Jitter.noise_tolerance = self.noise_tolerance
             self.process_and_show_data()
         
         def correct_jitter_clicked():
-            self.get_source_data_item()            
-            self.Jitter.blur_radius = self.sigma
-            self.Jitter.noise_tolerance = self.noise_tolerance
+            self.get_source_data_item()
             self.correct_jitter()
         
         
@@ -79,6 +129,9 @@ class JitterPanelDelegate(object):
         self.noise_tolerance_field = ui.create_line_edit_widget()
         self.noise_tolerance_field.text = str(self.noise_tolerance)
         self.noise_tolerance_field.on_editing_finished = noise_tolerance_finished
+        self.reference_channel_field = ui.create_line_edit_widget()
+        self.reference_channel_field.text = str(self.reference_channel)
+        self.reference_channel_field.on_editing_finished = reference_channel_finished
         self.box_size_field = ui.create_line_edit_widget()
         self.box_size_field.text = str(self.box_size)
         self.box_size_field.on_editing_finished = box_size_finished
@@ -89,6 +142,9 @@ class JitterPanelDelegate(object):
         self.correct_jitter_button = ui.create_push_button_widget('Correct jitter')
         self.correct_jitter_button.on_clicked = correct_jitter_clicked
         
+        self.preview_check_box = ui.create_check_box_widget(_('Live preview'))
+        self.preview_check_box.on_checked_changed = preview_changed
+        
         fields_row = ui.create_row_widget()
         fields_row.add_spacing(5)
         fields_row.add(ui.create_label_widget('Sigma: '))
@@ -103,6 +159,9 @@ class JitterPanelDelegate(object):
         fields_row2.add_spacing(5)
         fields_row2.add(ui.create_label_widget('Noise tolerance: '))
         fields_row2.add(self.noise_tolerance_field)
+        fields_row2.add_spacing(10)
+        fields_row2.add(ui.create_label_widget('Reference channel: '))
+        fields_row2.add(self.reference_channel_field)
         fields_row2.add_spacing(5)
         fields_row2.add_stretch()
         
@@ -114,109 +173,212 @@ class JitterPanelDelegate(object):
         button_row.add_spacing(5)
         button_row.add_stretch()
         
+        preview_row = ui.create_row_widget()
+        preview_row.add_spacing(5)
+        preview_row.add(self.preview_check_box)
+        preview_row.add_spacing(5)
+        preview_row.add_stretch()
+        
+        self.status_label = ui.create_label_widget('')
+        status_row = ui.create_row_widget()
+        status_row.add_spacing(5)
+        status_row.add(self.status_label)
+        status_row.add_spacing(5)
+        status_row.add_stretch()
+        
         column.add_spacing(5)
         column.add(fields_row)
         column.add_spacing(10)
         column.add(fields_row2)
         column.add_spacing(10)
         column.add(button_row)
+        column.add_spacing(10)
+        column.add(preview_row)
+        column.add_spacing(10)
+        column.add(status_row)
         column.add_spacing(5)
         column.add_stretch()
 
         return column
         
-    def process_and_show_data(self):
+    def process_and_show_data(self, delay=0):
         if self.source_data_item is None:
             return
+        self.last_job = self.process_and_show_data
+        parameters = self.current_parameters()
             
-        if self.t is not None and self.t.is_alive():
-            print('Still working. Wait until finished.')
-            return
-            
-        def do_processing():
+        def do_processing(cancel_event):
+            self.prepare_jitter(parameters, cancel_event)
+            self.instrumentation.message('blurring image')
+            blurred_data = self.Jitter.blurred_image
             if self.processed_data_item is None:
-                xdata = copy.deepcopy(self.source_data_item.xdata)
-                self.processed_data_item = self.document_controller.create_data_item_from_data_and_metadata(xdata,
+                self.processed_data_item = self.document_controller.create_data_item_from_data_and_metadata(
+                                                                self.xdata_like_source(blurred_data),
                                                                 title='Local Maxima of ' + self.source_data_item.title)
-            print('blurring image')    
             self.processed_data_item.title = 'Local Maxima of ' + self.source_data_item.title
-            blurred_data = self.Jitter.gaussian_blur(sigma=self.sigma)
-            print('finding maxima')
-            maxima = self.Jitter.local_maxima[1]
-            print('Done')
-            shape = self.source_data_item.xdata.data_shape
+            self.instrumentation.message('finding maxima')
+            maxima = self.Jitter.maxima
+            self.Jitter.check_cancelled()
+            shape = blurred_data.shape
             number_maxima = len(maxima)
-            #logging.info('Found {:.0f} maxima'.format(number_maxima))
-#            crosssize = max(min(np.amin(shape)/np.sqrt(number_maxima)/2, np.amin(shape)/20), 3)
-#            crosscolor = np.mean(blurred_data)
-#            for maximum in maxima:
-#                self.draw_cross(blurred_data, maximum, crosssize, color=crosscolor)
-            self.processed_data_item.set_data(blurred_data)
-            if number_maxima < 3000:
-                logging.info('Found {:.0f} maxima'.format(number_maxima))
-            else:
-                logging.info('Found {:.0f} maxima (only showing {:.0f} for performance reasons)'.format(number_maxima,
-                                                                             number_maxima//((number_maxima//3000)+1)))
-            with self.document_controller.library.data_ref_for_data_item(self.processed_data_item):
-                for region in self.processed_data_item.regions:
-                    if region.type == 'point-region':
-                        try:
-                            self.processed_data_item.remove_region(region)
-                        except:
-                            pass
-                for i in range(number_maxima):
-                    if number_maxima < 3000 or i%((number_maxima//3000)+1) == 0:
-                        maximum = maxima[i]
-                        self.processed_data_item.add_point_region(maximum[0]/shape[0], maximum[1]/shape[1])
-        self.t = threading.Thread(target=do_processing)
-        self.t.start()
-        #do_processing()
+            logging.info('Found {:.0f} maxima'.format(number_maxima))
+            # All maxima are drawn as crosses into a copy of the blurred image in one vectorized step. This is much
+            # faster than one point region per maximum, so there is no need to show only some of them.
+            crosssize = max(min(np.amin(shape)/np.sqrt(max(number_maxima, 1))/2, np.amin(shape)/20), 3)
+            marked_data = np.array(blurred_data)
+            correct_jitter.draw_markers(marked_data, maxima, crosssize, color=np.amax(blurred_data))
+            self.processed_data_item.set_data(marked_data)
+            self.instrumentation.message('Done')
+        self.scheduler.submit(do_processing, delay=delay)
     
-    def correct_jitter(self):
+    def correct_jitter(self, delay=0):
         if self.source_data_item is None:
             return
-        if self.t is not None and self.t.is_alive():
-            print('Still working. Wait until finished.')
-            return
+        self.last_job = self.correct_jitter
+        parameters = self.current_parameters()
         
-        def do_processing():
+        def do_processing(cancel_event):
+            self.prepare_jitter(parameters, cancel_event)
+            # Maxima are only calculated again if sigma or noise tolerance changed
+            if parameters['channel_axis'] is not None:
+                corrected_data = self.Jitter.correct_channels(parameters['source_data'],
+                                                              box_size=parameters['box_size'],
+                                                              channel_axis=parameters['channel_axis'])
+            else:
+                coordinate_offsets = self.Jitter.dejitter_full_image(box_size=parameters['box_size'])
+                corrected_data = self.Jitter.apply_correction(coordinate_offsets)
+            self.Jitter.check_cancelled()
             if self.dejittered_data_item is None:
-                xdata = copy.deepcopy(self.source_data_item.xdata)
-                self.dejittered_data_item = self.document_controller.create_data_item_from_data_and_metadata(xdata,
+                self.dejittered_data_item = self.document_controller.create_data_item_from_data_and_metadata(
+                                                                    self.xdata_like_source(corrected_data),
                                                                     title='Dejittered ' + self.source_data_item.title)
-            coordinate_offsets = self.Jitter.dejitter_full_image(box_size=self.box_size)
             self.dejittered_data_item.title = 'Dejittered ' + self.source_data_item.title
-            self.dejittered_data_item.set_data(self.Jitter.apply_correction(coordinate_offsets))
+            self.dejittered_data_item.set_data(corrected_data)
+        
+        self.scheduler.submit(do_processing, delay=delay)
+    
+    def preview(self, delay=0):
+        # Corrects only the preview region, "Correct jitter" runs the correction on the full image
+        if self.source_data_item is None:
+            return
+        parameters = self.current_parameters()
+        region = self.preview_region()
+        
+        def do_processing(cancel_event):
+            self.prepare_jitter(parameters, cancel_event)
+            corrected_data = self.Jitter.dejitter_region(region, box_size=parameters['box_size'])
+            self.Jitter.check_cancelled()
+            if self.preview_data_item is None:
+                self.preview_data_item = self.document_controller.create_data_item_from_data_and_metadata(
+                                                                    self.xdata_like_source(corrected_data),
+                                                                    title='Preview of ' + self.source_data_item.title)
+            self.preview_data_item.title = 'Preview of ' + self.source_data_item.title
+            self.preview_data_item.set_data(corrected_data)
         
-        self.t = threading.Thread(target=do_processing)
-        self.t.start()
+        self.scheduler.submit(do_processing, delay=delay)
     
+    def preview_region(self):
+        # The last rectangle region on the source data item or a square in the center of the image
+        shape = self.source_data_item.xdata.data_shape
+        if self.channel_axis(self.source_data_item.xdata) is not None:
+            shape = shape[:2] if self.channel_axis(self.source_data_item.xdata) == -1 else shape[1:]
+        for region in reversed(self.source_data_item.regions):
+            if region.type in ('rectangle-region', 'rect-graphic'):
+                (top, left), (height, width) = region.get_property('bounds')
+                top = min(max(int(top*shape[0]), 0), shape[0] - 1)
+                left = min(max(int(left*shape[1]), 0), shape[1] - 1)
+                return (slice(top, max(int(top + height*shape[0]), top + 1)),
+                        slice(left, max(int(left + width*shape[1]), left + 1)))
+        top = max((shape[0] - self.preview_size)//2, 0)
+        left = max((shape[1] - self.preview_size)//2, 0)
+        return (slice(top, top + self.preview_size), slice(left, left + self.preview_size))
+    
+    def current_parameters(self):
+        return {'source_data': self.source_data_item.data, 'sigma': self.sigma,
+                'noise_tolerance': self.noise_tolerance, 'box_size': self.box_size,
+                'reference_channel': self.reference_channel,
+                'channel_axis': self.channel_axis(self.source_data_item.xdata)}
+    
+    def channel_axis(self, xdata):
+        # None for images, -1 for spectrum images (H, W, E) and 0 for stacks of images (C, H, W)
+        if len(xdata.data_shape) != 3:
+            return None
+        return -1 if xdata.datum_dimension_count == 1 else 0
+    
+    def prepare_jitter(self, parameters, cancel_event):
+        # Runs in the job, so that a new image or new parameters do not change the data of a running job. Setting the
+        # same values again keeps the cached blurred image and maxima.
+        self.Jitter.cancel_event = cancel_event
+        self.instrumentation.reset()
+        image = parameters['source_data']
+        if parameters['channel_axis'] is not None:
+            # The reference image is kept as long as data and reference channel stay the same
+            if (self.reference is None or self.reference[0] is not image or
+                    self.reference[1] != parameters['reference_channel']):
+                if 0 <= parameters['reference_channel'] < image.shape[parameters['channel_axis']]:
+                    reference_image = np.take(image, parameters['reference_channel'], axis=parameters['channel_axis'])
+                else:
+                    reference_image = np.sum(image, axis=parameters['channel_axis'])
+                self.reference = (image, parameters['reference_channel'], reference_image)
+            image = self.reference[2]
+        if self.Jitter.image is not image:
+            self.Jitter.image = image
+        self.Jitter.blur_radius = parameters['sigma']
+        self.Jitter.noise_tolerance = parameters['noise_tolerance']
+    
+    def instrumentation_event(self, event_type, name, value):
+        # Called from the processing thread for every event of self.instrumentation
+        if event_type == 'message':
+            self.progress = name
+        elif event_type == 'stage_started':
+            self.progress = name.replace('_', ' ') + '...'
+        elif event_type == 'stage_finished' and self.progress == name.replace('_', ' ') + '...':
+            self.progress = ''
+        self.show_status(self.progress)
+
+    def show_status(self, progress):
+        # Shows "progress" and the timings of the last job in the status label (can be called from any thread)
+        text = progress + '\n' + self.instrumentation.report() if progress else self.instrumentation.report()
+        def update_label():
+            if self.status_label is not None:
+                self.status_label.text = text
+        self.__api.queue_task(update_label)
+
+    def xdata_like_source(self, data):
+        # Wraps "data" with the calibrations and metadata of the source data item. This avoids a deep copy of the
+        # (possibly very large) source data just to create a new data item.
+        xdata = self.source_data_item.xdata
+        dimensional_calibrations = list(xdata.dimensional_calibrations)
+        data_descriptor = xdata.data_descriptor
+        if len(dimensional_calibrations) == 3 and np.ndim(data) == 2:
+            # Images calculated from the reference channel of a stack or spectrum image
+            del dimensional_calibrations[self.channel_axis(xdata)]
+            data_descriptor = None
+        return self.__api.create_data_and_metadata(data, intensity_calibration=xdata.intensity_calibration,
+                                                   dimensional_calibrations=dimensional_calibrations,
+                                                   metadata=copy.deepcopy(xdata.metadata),
+                                                   data_descriptor=data_descriptor)
+
     def get_source_data_item(self):
         try:
             if (self.source_data_item is None or
                 (self.document_controller.target_data_item.specifier.object_uuid != self.source_data_item.specifier.object_uuid and
                  (self.dejittered_data_item is None or self.dejittered_data_item.specifier.object_uuid != self.document_controller.target_data_item.specifier.object_uuid) and
-                 (self.processed_data_item is None or self.processed_data_item.specifier.object_uuid != self.document_controller.target_data_item.specifier.object_uuid))):
+                 (self.processed_data_item is None or self.processed_data_item.specifier.object_uuid != self.document_controller.target_data_item.specifier.object_uuid) and
+                 (self.preview_data_item is None or self.preview_data_item.specifier.object_uuid != self.document_controller.target_data_item.specifier.object_uuid))):
                     self.source_data_item = self.document_controller.target_data_item
-                    self.Jitter.image = self.source_data_item.data
         except AttributeError:
             self.source_data_item = None
 
-    def draw_cross(self, data, coords, size, color=1):
-        coords = np.array(coords)
-        shape = np.array(data.shape)
-        halfsize = int(np.rint(size/2))
-        if (coords - halfsize > 0).all() and (coords + halfsize < shape - 1).all():
-            data[coords[0]-halfsize:coords[0]+halfsize+1, coords[1]] += color
-            data[coords[0], coords[1]-halfsize:coords[1]+halfsize+1] += color
-        
 class JitterExtension(object):
     extension_id = 'univie.jittercorrector'
     
     def __init__(self, api_broker):
         api = api_broker.get_api(version='1', ui_version='1')
-        self.__panel_ref = api.create_panel(JitterPanelDelegate(api))
+        self.__panel_delegate = JitterPanelDelegate(api)
+        self.__panel_ref = api.create_panel(self.__panel_delegate)
     
     def close(self):
+        self.__panel_delegate.scheduler.close()
         self.__panel_ref.close()
         self.__panel_ref = None
\ No newline at end of file
@@ -14,7 +14,8 @@ setuptools.setup(
     author_email='Brow71189@gmail.com',
     description='Correct beam jitter in STEM images',
     packages=['nionswift_plugin.jitter_wizard', 'jitter_utils'],
-    install_requires=['AnalyzeMaxima'],
+    extras_require={'analyzemaxima': ['AnalyzeMaxima'], 'tiff': ['tifffile'], 'hdf5': ['h5py'], 'numba': ['numba']},
+    entry_points={'console_scripts': ['jitterwizard=jitter_utils.batch:main']},
     license='MIT',
     include_package_data=True,
     python_requires='~=3.5',
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+Makes jitter_utils importable when the tests are run from a source checkout.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Compares correct_jitter.analyze_maxima_numpy with a Python port of the flood fill in AnalyzeMaxima.
+"""
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from jitter_utils import correct_jitter
+
+def flood_fill_maxima(image, sorted_maxima, noise_tolerance):
+    # Line by line port of AnalyzeMaxima.analyze_maxima. Each maximum floods the pixels >= its value - noise_tolerance.
+    # It is rejected if the flood reaches a brighter pixel or a pixel flooded by an earlier maximum.
+    shape = image.shape
+    attributes = np.zeros(image.size, dtype=np.uint8)  # 1: listed, 2: processed
+    y_positions = [1, -1, 0, 1, -1, 0, 1, -1]
+    x_positions = [0, 0, 1, 1, 1, -1, -1, -1]
+    resulting_maxima = []
+    for maximum in sorted_maxima:
+        maximum = int(maximum)
+        point_list = [divmod(maximum, shape[1])]
+        attributes[maximum] = 1
+        maximum_value = image[point_list[0]]
+        maximum_possible = True
+        index = 0
+        while index < len(point_list):
+            y, x = point_list[index]
+            for k in range(8):
+                current_y = y + y_positions[k]
+                current_x = x + x_positions[k]
+                if current_y < 0 or current_x < 0 or current_y >= shape[0] or current_x >= shape[1]:
+                    continue
+                current_flat = current_y*shape[1] + current_x
+                if attributes[current_flat] == 1:
+                    continue
+                elif attributes[current_flat] == 2:
+                    maximum_possible = False
+                    break
+                current_value = image[current_y, current_x]
+                if current_value > maximum_value:
+                    maximum_possible = False
+                    break
+                if current_value >= maximum_value - noise_tolerance:
+                    point_list.append((current_y, current_x))
+                    attributes[current_flat] = 1
+            if not maximum_possible:
+                break
+            index += 1
+        for y, x in point_list:
+            attributes[y*shape[1] + x] = 2
+        if maximum_possible:
+            resulting_maxima.append(maximum)
+    return np.array(resulting_maxima, dtype=np.intp)
+
+def sorted_maxima(image):
+    # Local maxima sorted like in Jitter.analyze_and_mark_maxima (brightest first, ties in row-major order)
+    jitter = correct_jitter.Jitter()
+    jitter.image = image
+    jitter.blur_radius = 0
+    maxima = jitter.raw_local_maxima[1]
+    flat_maxima = maxima[:, 0]*image.shape[1] + maxima[:, 1]
+    return flat_maxima[np.argsort(-image.ravel()[flat_maxima], kind='mergesort')]
+
+def lattice(shape, spacing, seed):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    image = np.zeros(shape)
+    for center_y in np.arange(spacing/2, shape[0], spacing):
+        for center_x in np.arange(spacing/2, shape[1], spacing) + rng.normal(0, 1):
+            image += 50*np.exp(-((y - center_y)**2 + (x - center_x)**2)/(2*(spacing/5)**2))
+    return ndimage.gaussian_filter(image + rng.poisson(5, shape), 1.5)
+
+def make_images():
+    rng = np.random.RandomState(1)
+    smooth = ndimage.gaussian_filter(rng.random_sample((90, 110)), 2)
+    # Brightest value at the image border, where no maximum is found
+    border = ndimage.gaussian_filter(rng.random_sample((60, 70)), 3) + np.linspace(0, 0.2, 70)
+    return {'lattice': lattice((96, 120), 12, 0),
+            'dense lattice': lattice((80, 80), 6, 1),
+            'plateaus': rng.randint(0, 4, (60, 70)).astype(np.float64),
+            'ties': np.round(smooth*40),
+            'smooth': smooth*100,
+            'border': border*100,
+            'zeros': np.zeros((30, 40))}
+
+IMAGES = make_images()
+
+@pytest.mark.parametrize('noise_tolerance', [0, 0.5, 1, 3, 10, 1000])
+@pytest.mark.parametrize('name', sorted(IMAGES))
+def test_same_maxima_as_flood_fill(name, noise_tolerance):
+    # analyze_and_mark_maxima passes the blurred image as float32
+    image = IMAGES[name].astype(np.float32)
+    maxima = sorted_maxima(image)
+    expected = flood_fill_maxima(image, maxima, noise_tolerance)
+    np.testing.assert_array_equal(correct_jitter.analyze_maxima_numpy(image, maxima, noise_tolerance), expected)
+
+def test_small_windows():
+    # Start with the smallest window and small batches, so that windows are enlarged several times
+    image = IMAGES['lattice'].astype(np.float32)
+    maxima = sorted_maxima(image)
+    for noise_tolerance in (1, 10, 30):
+        np.testing.assert_array_equal(correct_jitter.analyze_maxima_numpy(image, maxima, noise_tolerance, radius=1,
+                                                                          max_elements=200),
+                                      flood_fill_maxima(image, maxima, noise_tolerance))
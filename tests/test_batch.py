@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the jitterwizard command line tool.
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+from jitter_utils import batch
+
+def lattice(size=64, spacing=8, seed=0):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:size, :size].astype(float)
+    x += rng.normal(0, 1, size)[:, np.newaxis]
+    image = np.zeros((size, size))
+    for center_y in np.arange(spacing/2, size, spacing):
+        for center_x in np.arange(spacing/2, size, spacing):
+            image += 80*np.exp(-((y - center_y)**2 + (x - center_x)**2)/(2*(spacing/6)**2))
+    return rng.poisson(image + 10).astype(np.uint16)
+
+def run(paths, output_dir, **kwargs):
+    return batch.run(paths, 1.5, 5, 8, str(output_dir), **kwargs)
+
+@pytest.fixture
+def inputs(tmp_path):
+    paths = []
+    for index, directory in enumerate(('a', 'b')):
+        os.makedirs(str(tmp_path / 'in' / directory))
+        paths.append(str(tmp_path / 'in' / directory / 'x.npy'))
+        np.save(paths[-1], lattice(seed=index))
+    return paths
+
+def test_skips_files_in_manifest(inputs, tmp_path, capsys):
+    assert run(inputs, tmp_path / 'out') == 0
+    assert os.path.exists(str(tmp_path / 'out' / 'a' / 'x_dejittered.npy'))
+    assert os.path.exists(str(tmp_path / 'out' / 'b' / 'x_dejittered.npy'))
+    capsys.readouterr()
+    assert run(inputs, tmp_path / 'out') == 0
+    assert capsys.readouterr().out.count('already dejittered') == 2
+    # Changed parameters are processed again
+    assert run(inputs, tmp_path / 'out', dataset='data') == 0
+    assert 'already dejittered' not in capsys.readouterr().out
+
+def test_other_output_path_is_not_skipped(inputs, tmp_path, capsys):
+    assert run(inputs, tmp_path / 'out') == 0
+    capsys.readouterr()
+    manifest = batch.load_manifest(str(tmp_path / 'out'))
+    # Same file and parameters, but the manifest points to another result
+    for path in inputs:
+        manifest[path]['output'] = str(tmp_path / 'elsewhere.npy')
+        np.save(manifest[path]['output'], np.zeros(1))
+    batch.save_manifest(str(tmp_path / 'out'), manifest)
+    assert run(inputs, tmp_path / 'out') == 0
+    assert 'already dejittered' not in capsys.readouterr().out
+
+def test_colliding_output_names(tmp_path):
+    paths = [str(tmp_path / 'x.npy'), str(tmp_path / 'x.tif')]
+    with pytest.raises(ValueError):
+        batch.output_paths(paths, str(tmp_path / 'out'), output_format='.npy')
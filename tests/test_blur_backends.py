@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the blur backends with ndimage.gaussian_filter in float64.
+"""
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from jitter_utils import blur_backends
+
+def make_image(shape, dtype, seed=0):
+    # Random background with a few bright Gaussian spots, scaled to the range of typical STEM images
+    rng = np.random.RandomState(seed)
+    image = ndimage.gaussian_filter(rng.random_sample(shape), 1.5)
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    for center in rng.random_sample((20, 2)) * shape:
+        image += 5*np.exp(-((y - center[0])**2 + (x - center[1])**2)/8)
+    return (image * 1000).astype(dtype)
+
+def relative_error(result, reference):
+    return np.amax(np.abs(result - reference)) / np.amax(np.abs(reference))
+
+# The recursive backend only approximates the Gaussian kernel. On these images with sharp spots it deviates by up to
+# 5.2 % of the peak (for sigma <= 2 and near the borders of the narrow image), so it gets a tolerance of its own.
+@pytest.mark.parametrize('backend, result_dtype, tolerance', [('float32', np.float32, 4e-7), ('fft', np.float32, 2e-6),
+                                                              ('recursive', np.float64, 6e-2)])
+@pytest.mark.parametrize('sigma', [0.7, 2, 5.5, 12, (2, 6)])
+@pytest.mark.parametrize('shape, dtype', [((128, 160), np.uint16), ((97, 211), np.float64), ((300, 40), np.float32)])
+def test_backend_matches_gaussian_filter(backend, result_dtype, tolerance, sigma, shape, dtype):
+    image = make_image(shape, dtype)
+    reference = ndimage.gaussian_filter(image.astype(np.float64), sigma)
+    result = blur_backends.gaussian_blur(image, sigma, backend=backend)
+    assert result.shape == image.shape
+    assert result.dtype == result_dtype
+    assert relative_error(result, reference) < tolerance
+
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int32, np.float32, np.float64])
+def test_ndimage_backend_is_exact(dtype):
+    image = make_image((120, 130), dtype)
+    reference = ndimage.gaussian_filter(image.astype(np.float64), 2.5)
+    np.testing.assert_array_equal(blur_backends.gaussian_blur(image, 2.5, backend='ndimage'), reference)
+    output = np.empty(image.shape)
+    assert blur_backends.gaussian_blur(image, 2.5, backend='ndimage', output=output) is output
+    np.testing.assert_array_equal(output, reference)
+
+@pytest.mark.parametrize('dtype', [np.uint16, np.float32, np.float64])
+def test_float32_backend_output(dtype):
+    image = make_image((120, 130), dtype)
+    reference = blur_backends.gaussian_blur(image, 3, backend='float32')
+    output = np.empty(image.shape, dtype=np.float32)
+    assert blur_backends.gaussian_blur(image, 3, backend='float32', output=output) is output
+    np.testing.assert_array_equal(output, reference)
+    # Outputs of another data type are not used
+    assert blur_backends.gaussian_blur(image, 3, backend='float32', output=np.empty(image.shape)).dtype == np.float32
+
+def test_choose_blur_backend():
+    assert blur_backends.choose_blur_backend((256, 256), 10) == 'ndimage'
+    assert blur_backends.choose_blur_backend((2048, 2048), 2) == 'ndimage'
+    assert blur_backends.choose_blur_backend((2048, 2048), 4) == 'float32'
+    assert blur_backends.choose_blur_backend((2048, 2048), 10) == 'fft'
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        blur_backends.gaussian_blur(np.zeros((10, 10)), 1, backend='spline')
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Compares Jitter.dejitter_full_image with a copy of the original loop over the maxima, which corrected one box after
+the other with masked arrays.
+"""
+
+import numpy as np
+import pytest
+
+from jitter_utils import correct_jitter
+from jitter_utils import instrumentation
+
+def remove_y_jitter(crop_im, mask):
+    # Original Jitter.remove_y_jitter(crop_im, return_coordinates=True, mask=mask)
+    shape = crop_im.shape
+    crop_im = np.ma.masked_array(crop_im, mask=mask)
+    tophalf = crop_im[:int(shape[0]/2)]
+    bottomhalf = crop_im[int(shape[0]/2):]
+    corrected_crop_im = np.zeros(shape)
+    corrected_crop_im[:int(shape[0]/2)] = np.expand_dims(np.argsort(np.mean(tophalf, axis=1)),
+                                                         axis=1).repeat(shape[1], axis=1)
+    corrected_crop_im[int(shape[0]/2):] = np.expand_dims(np.argsort(np.mean(bottomhalf, axis=1))[::-1],
+                                                         axis=1).repeat(shape[1], axis=1) + int(shape[0]/2)
+    org_indices = np.expand_dims(np.arange(shape[0]), axis=1).repeat(shape[1], axis=1)
+    corrected_crop_im[mask] = org_indices[mask]
+    return corrected_crop_im
+
+def remove_x_jitter_com(crop_im, mask):
+    # Original Jitter.remove_x_jitter_com(crop_im, return_coordinates=True, mask=mask)
+    shape = crop_im.shape
+    crop_im = np.ma.masked_array(crop_im, mask=mask)
+    com_lines = np.ma.masked_array(np.mgrid[:shape[0], :shape[1]][1], mask=mask)
+    com_lines = np.sum(com_lines*crop_im, axis=1)/np.sum(crop_im, axis=1) - shape[1]/2
+    mean_com = np.mean(com_lines)
+    x_corrected_crop_im = np.zeros(shape)
+    for i in range(shape[0]):
+        x_corrected_crop_im[i] = np.arange(0, shape[1]) + (com_lines[i] - mean_com)
+    org_indices = np.expand_dims(np.arange(shape[1]), axis=0).repeat(shape[0], axis=0)
+    x_corrected_crop_im[mask] = org_indices[mask]
+    return x_corrected_crop_im
+
+def apply_correction(image, coordinate_offsets):
+    # Original Jitter.apply_correction
+    new_coordinates = np.mgrid[0:image.shape[0], 0:image.shape[1]].astype(np.float32)
+    new_coordinates += coordinate_offsets
+    return image[new_coordinates[0].astype(int), new_coordinates[1].astype(int)].copy()
+
+def original_dejitter(image, local_maxima, box_size):
+    # Original Jitter.dejitter_full_image with the maxima as argument
+    half_box_size = int(box_size/2)
+    if box_size%2 == 0:
+        box_size = int(box_size + 1)
+    else:
+        box_size = int(box_size)
+    mask = np.ones((box_size, box_size), dtype=bool)
+    correct_jitter.draw_circle(mask, (half_box_size, half_box_size), half_box_size, color=False)
+    mask = mask[:-1, :-1]
+    shape = image.shape
+    coordinate_offsets = np.mgrid[0:shape[0], 0:shape[1]]
+    for maximum in local_maxima:
+        max_array = np.array(maximum)
+        if (max_array < half_box_size).any() or (max_array >= np.array(shape) - half_box_size - 1).any():
+            continue
+        chunk = (maximum[0]-half_box_size, maximum[0]+half_box_size, maximum[1]-half_box_size,
+                 maximum[1]+half_box_size)
+        new_y_coords = remove_y_jitter(image[chunk[0]:chunk[1], chunk[2]:chunk[3]], mask)
+        coordinate_offsets[0][chunk[0]:chunk[1], chunk[2]:chunk[3]] = maximum[0] - half_box_size + new_y_coords
+    coordinate_offsets -= np.mgrid[0:shape[0], 0:shape[1]]
+    y_corrected = apply_correction(image, coordinate_offsets)
+    y_corrected -= np.amin(y_corrected)
+    coordinate_offsets += np.mgrid[0:shape[0], 0:shape[1]]
+    for maximum in local_maxima:
+        max_array = np.array(maximum)
+        if (max_array < half_box_size).any() or (max_array >= np.array(shape) - half_box_size - 1).any():
+            continue
+        chunk = (maximum[0]-half_box_size, maximum[0]+half_box_size, maximum[1]-half_box_size,
+                 maximum[1]+half_box_size)
+        new_x_coords = remove_x_jitter_com(y_corrected[chunk[0]:chunk[1], chunk[2]:chunk[3]], mask)
+        coordinate_offsets[1][chunk[0]:chunk[1], chunk[2]:chunk[3]] = maximum[1] - half_box_size + new_x_coords
+    coordinate_offsets -= np.mgrid[0:shape[0], 0:shape[1]]
+    return coordinate_offsets
+
+def jittered_lattice(dtype, size=96, spacing=12, counts=200, seed=0):
+    # Lattice of Gaussian atoms with random row shifts and Poisson noise, scaled to the range of "dtype"
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:size, :size].astype(float)
+    x += rng.normal(0, 1.5, size)[:, np.newaxis]
+    image = np.zeros((size, size))
+    for center_y in np.arange(spacing/2, size, spacing):
+        for center_x in np.arange(spacing/2, size, spacing):
+            image += np.exp(-((y - center_y)**2 + (x - center_x)**2)/(2*(spacing/6)**2))
+    image = rng.poisson(counts*image + counts/10).astype(float)
+    if dtype == np.uint8:
+        image *= 255/np.amax(image)
+    return image.astype(dtype)
+
+def dejitter(image, box_size, fused):
+    jitter = correct_jitter.Jitter(kernel_backend='numpy',
+                                   instrumentation=instrumentation.Instrumentation(callback=lambda *event: None))
+    jitter.image = image
+    jitter.blur_radius = 2
+    jitter.noise_tolerance = 5
+    coordinate_offsets = jitter.dejitter_full_image(box_size=box_size, fused=fused)
+    np.testing.assert_array_equal(coordinate_offsets, original_dejitter(image, jitter.maxima, box_size))
+
+@pytest.mark.parametrize('fused', [False, True])
+@pytest.mark.parametrize('box_size', [9, 10, 16, 17])
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.float16, np.float32, np.float64])
+def test_same_offsets_as_original_loop(dtype, box_size, fused):
+    dejitter(jittered_lattice(dtype), box_size, fused)
+
+@pytest.mark.parametrize('fused', [False, True])
+def test_float16_large_boxes(fused):
+    # Row means of large float16 boxes are rounded in a way that changes the order of rows with similar means
+    dejitter(jittered_lattice(np.float16, size=192, spacing=14, counts=1000), 60, fused)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the Numba kernels with the NumPy code. Skipped if Numba is not installed.
+"""
+
+import numpy as np
+import pytest
+
+from jitter_utils import caching
+from jitter_utils import correct_jitter
+from jitter_utils import instrumentation
+
+pytest.importorskip('numba')
+
+def jittered_lattice(dtype, size=128, spacing=10, seed=0):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:size, :size].astype(float)
+    x += rng.normal(0, 1.5, size)[:, np.newaxis]
+    image = np.zeros((size, size))
+    for center_y in np.arange(spacing/2, size, spacing):
+        for center_x in np.arange(spacing/2, size, spacing):
+            image += np.exp(-((y - center_y)**2 + (x - center_x)**2)/(2*(spacing/6)**2))
+    image = rng.poisson(200*image + 20).astype(float)
+    if dtype == np.uint8:
+        image *= 255/np.amax(image)
+    return image.astype(dtype)
+
+def dejitter(image, kernel_backend, box_size, overlap='last', **kwargs):
+    jitter = correct_jitter.Jitter(kernel_backend=kernel_backend, overlap=overlap,
+                                   instrumentation=instrumentation.Instrumentation(callback=lambda *event: None))
+    jitter.image = image
+    jitter.blur_radius = 2
+    jitter.noise_tolerance = 5
+    return jitter.dejitter_full_image(box_size=box_size, **kwargs)
+
+@pytest.mark.parametrize('subpixel', [False, True])
+@pytest.mark.parametrize('box_size', [9, 10, 16])
+@pytest.mark.parametrize('dtype', [np.uint8, np.uint16, np.int32])
+def test_same_offsets_as_numpy(dtype, box_size, subpixel):
+    # The kernels sum in float64, which is exact for integer images
+    image = jittered_lattice(dtype)
+    np.testing.assert_array_equal(dejitter(image, 'numba', box_size, subpixel=subpixel),
+                                  dejitter(image, 'numpy', box_size, subpixel=subpixel))
+
+def test_nearest_overlap_and_tiles():
+    image = jittered_lattice(np.uint16, seed=1)
+    expected = dejitter(image, 'numpy', 12, overlap='nearest')
+    np.testing.assert_array_equal(dejitter(image, 'numba', 12, overlap='nearest'), expected)
+    np.testing.assert_array_equal(dejitter(image, 'numba', 12, overlap='nearest', tile=48), expected)
+
+def test_float_images_are_close():
+    # Float sums are rounded differently than the pairwise summation of NumPy, so only the x-offsets can differ and
+    # only by little
+    image = jittered_lattice(np.float32)
+    numba_offsets = dejitter(image, 'numba', 10, subpixel=True)
+    numpy_offsets = dejitter(image, 'numpy', 10, subpixel=True)
+    np.testing.assert_allclose(numba_offsets, numpy_offsets, atol=1e-3)
+
+def test_offset_cache_separates_backends(tmp_path):
+    image = jittered_lattice(np.float32)
+    cache = caching.OffsetCache(str(tmp_path))
+    messages = []
+    for kernel_backend in ('numpy', 'numba'):
+        jitter = correct_jitter.Jitter(kernel_backend=kernel_backend, offset_cache=cache,
+                                       instrumentation=instrumentation.Instrumentation(
+                                           callback=lambda event_type, name, value: messages.append(name)))
+        jitter.image = image
+        jitter.blur_radius = 2
+        jitter.noise_tolerance = 5
+        jitter.dejitter_full_image(box_size=10, subpixel=True)
+    assert 'Using cached offsets' not in messages
+    assert len(cache._entries()) == 2
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for the line based jitter estimation (Jitter.dejitter_lines and line_shifts) on textures with known row shifts.
+"""
+
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from jitter_utils import correct_jitter
+from jitter_utils import instrumentation
+
+def jittered_texture(shape=(256, 1024), jitter=1.5, counts=None, seed=3):
+    # Amorphous texture in which row y shows the content at x - shift[y], so that adding shift[y] to the x-coordinates
+    # of the row (like the x-offsets do) corrects it. Returns the image and the shifts.
+    rng = np.random.RandomState(seed)
+    texture = ndimage.gaussian_filter(rng.random_sample((shape[0], shape[1] + 64)), 3)
+    shifts = rng.normal(0, jitter, shape[0])
+    y, x = np.mgrid[:shape[0], :shape[1]].astype(float)
+    image = ndimage.map_coordinates(texture, [y, x + 32 - shifts[:, np.newaxis]], order=3)
+    image /= np.amax(image)
+    if counts is not None:
+        return rng.poisson(image*counts).astype(np.uint16), shifts
+    return (image*1000).astype(np.float32), shifts
+
+def jitter_part(shifts, smoothing=8):
+    # line_shifts only detects the part of the shifts that changes within a few rows
+    return shifts - ndimage.gaussian_filter1d(shifts, smoothing, mode='nearest')
+
+def make_jitter(image, sigma=None):
+    jitter = correct_jitter.Jitter(instrumentation=instrumentation.Instrumentation(callback=lambda *event: None))
+    jitter.image = image
+    jitter.blur_radius = sigma
+    return jitter
+
+@pytest.mark.parametrize('counts, sigma, max_error', [(None, None, 0.25), (200, 2, 0.6)])
+def test_recovers_known_shifts(counts, sigma, max_error):
+    image, shifts = jittered_texture(counts=counts)
+    estimate = make_jitter(image, sigma).dejitter_lines(subpixel=True)[1][:, 0]
+    truth = jitter_part(shifts)
+    # Correlation instead of anti-correlation checks the sign of the offsets
+    assert np.corrcoef(estimate, truth)[0, 1] > 0.9
+    assert np.sqrt(np.mean((estimate - truth)**2)) < max_error
+
+def test_line_shifts_matches_dejitter_lines():
+    image, shifts = jittered_texture()
+    np.testing.assert_allclose(correct_jitter.line_shifts(image, strip_height=50),
+                               make_jitter(image).dejitter_lines(subpixel=True)[1][:, 0], atol=1e-4)
+
+def test_integer_and_subpixel_offsets():
+    image, shifts = jittered_texture()
+    jitter = make_jitter(image)
+    subpixel_offsets = jitter.dejitter_lines(subpixel=True)
+    integer_offsets = jitter.dejitter_lines()
+    assert subpixel_offsets.dtype == np.float32
+    assert np.issubdtype(integer_offsets.dtype, np.integer)
+    assert subpixel_offsets.shape == integer_offsets.shape == (2,) + image.shape
+    np.testing.assert_array_equal(integer_offsets[0], 0)
+    np.testing.assert_array_equal(subpixel_offsets[0], 0)
+    # Integer offsets are rounded, not truncated, and the same for all pixels of a row
+    np.testing.assert_array_equal(integer_offsets[1], np.rint(subpixel_offsets[1]))
+    assert np.all(integer_offsets[1] == integer_offsets[1][:, :1])
+    out = np.ones((2,) + image.shape, dtype=int)
+    assert jitter.dejitter_lines(out=out) is out
+    np.testing.assert_array_equal(out, integer_offsets)
+
+def test_correction_reduces_jitter_score():
+    image, shifts = jittered_texture()
+    jitter = make_jitter(image)
+    assert correct_jitter.jitter_score(image) > 4
+    for subpixel, order in ((False, 0), (True, 1)):
+        corrected = jitter.apply_correction(jitter.dejitter_lines(subpixel=subpixel), order=order)
+        assert correct_jitter.jitter_score(corrected) < 1.3
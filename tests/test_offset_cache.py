@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for looking up offsets of dejitter_full_image in caching.OffsetCache.
+"""
+
+import numpy as np
+import pytest
+
+from jitter_utils import caching
+from jitter_utils import correct_jitter
+from jitter_utils import instrumentation
+
+def lattice(shape=(96, 96), spacing=12, seed=0):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:shape[0], :shape[1]].astype(float)
+    x += rng.normal(0, 1, shape[0])[:, np.newaxis]
+    image = (np.exp(-((y + spacing/2) % spacing - spacing/2)**2 / 8) *
+             np.exp(-((x + spacing/2) % spacing - spacing/2)**2 / 8))
+    return rng.poisson(image * 200 + 10).astype(np.uint16)
+
+def dejitter(cache, image, sigma, noise_tolerance, box_size, **kwargs):
+    messages = []
+    jitter = correct_jitter.Jitter(offset_cache=cache, instrumentation=instrumentation.Instrumentation(
+        callback=lambda event_type, name, value: messages.append(name)))
+    jitter.image = image
+    jitter.blur_radius = sigma
+    jitter.noise_tolerance = noise_tolerance
+    offsets = jitter.dejitter_full_image(box_size=box_size, **kwargs)
+    return offsets, 'Using cached offsets' in messages
+
+@pytest.mark.parametrize('first, second', [((2, 5, 16), (2.0, 5.0, 16.0)), ((2, 1, 16), ((2, 2), 1, 16))])
+def test_equal_numbers_share_an_entry(tmp_path, first, second):
+    cache = caching.OffsetCache(str(tmp_path))
+    image = lattice()
+    offsets, cached = dejitter(cache, image, *first)
+    assert not cached
+    cached_offsets, cached = dejitter(cache, image, *second)
+    assert cached
+    np.testing.assert_array_equal(cached_offsets, offsets)
+    assert len(cache._entries()) == 1
+
+def test_tile_sizes_share_an_entry(tmp_path):
+    cache = caching.OffsetCache(str(tmp_path))
+    image = lattice()
+    dejitter(cache, image, 2, 1, 16, tile=48)
+    assert dejitter(cache, image, 2, 1, 16, tile=(48.0, 48))[1]
+    assert not dejitter(cache, image, 2, 1, 16, tile=64)[1]
+
+def test_different_parameters_miss(tmp_path):
+    cache = caching.OffsetCache(str(tmp_path))
+    image = lattice()
+    dejitter(cache, image, 2, 1, 16)
+    assert not dejitter(cache, image, 2.5, 1, 16)[1]
+    assert not dejitter(cache, image, 2, 1, 17)[1]
+    assert len(cache._entries()) == 3
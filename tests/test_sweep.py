@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for Jitter.sweep.
+"""
+
+import numpy as np
+
+from jitter_utils import correct_jitter
+from jitter_utils import instrumentation
+
+def lattice(size=128, spacing=10, seed=0):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:size, :size].astype(float)
+    x += rng.normal(0, 1, size)[:, np.newaxis]
+    image = np.zeros((size, size))
+    for center_y in np.arange(spacing/2, size, spacing):
+        for center_x in np.arange(spacing/2, size, spacing):
+            image += 80*np.exp(-((y - center_y)**2 + (x - center_x)**2)/(2*(spacing/6)**2))
+    return rng.poisson(image + 10).astype(np.uint16)
+
+def test_maxima_found_once_per_parameter_pair(capsys):
+    events = []
+    jitter = correct_jitter.Jitter(instrumentation=instrumentation.Instrumentation(
+                                                                    callback=lambda *event: events.append(event)))
+    jitter.image = lattice()
+    results = jitter.sweep([1.5, 2], [20], [8, 10, 12, 14], workers=4)
+    assert len(results) == 8
+    assert jitter.instrumentation.stages['find_local_maxima']['calls'] == 2
+    assert jitter.instrumentation.stages['analyze_and_mark_maxima']['calls'] == 2
+    # Messages go to the callback of the caller instead of stdout
+    assert any(event[0] == 'message' for event in events)
+    assert capsys.readouterr().out == ''
+
+def test_same_offsets_as_dejitter_full_image():
+    image = lattice(seed=1)
+    jitter = correct_jitter.Jitter(instrumentation=instrumentation.Instrumentation(callback=lambda *event: None))
+    jitter.image = image
+    for result in jitter.sweep([2], [5, 20], [10, 12], cache=True):
+        expected = correct_jitter.Jitter(instrumentation=jitter.instrumentation)
+        expected.image = image
+        expected.blur_radius = result['sigma']
+        expected.noise_tolerance = result['noise_tolerance']
+        np.testing.assert_array_equal(result['coordinate_offsets'],
+                                      expected.dejitter_full_image(box_size=result['box_size']))
+        assert result['number_maxima'] == len(expected.maxima)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+"""
+Compares Jitter.dejitter_tiled with dejitter_full_image.
+"""
+
+import numpy as np
+import pytest
+
+from jitter_utils import correct_jitter
+
+def jittered_lattice(size=160, spacing=10, seed=0):
+    # Lattice of Gaussian atoms with random shifts of the rows along x and Poisson noise, values up to about 100
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[:size, :size].astype(float)
+    x += rng.normal(0, 1, size)[:, np.newaxis]
+    image = np.zeros((size, size))
+    for center_y in np.arange(spacing/2, size, spacing):
+        for center_x in np.arange(spacing/2, size, spacing):
+            image += 80*np.exp(-((y - center_y)**2 + (x - center_x)**2)/(2*(spacing/6)**2))
+    return rng.poisson(image + 10).astype(np.uint16)
+
+def ridge():
+    # Two peaks connected by a ridge: depending on the noise tolerance the lower peak is rejected by the flood fill,
+    # although it is further away from the higher peak than the tile halo
+    y, x = np.mgrid[:100, :300].astype(float)
+    image = (100*np.exp(-((y - 50)**2 + (x - 40)**2)/50) + 90*np.exp(-((y - 50)**2 + (x - 260)**2)/50) +
+             50*np.exp(-(y - 50)**2/50)*((x > 40) & (x < 260)))
+    return (image + 5).astype(np.float32)
+
+def dejitter(image, noise_tolerance, sigma=2, box_size=10, **kwargs):
+    jitter = correct_jitter.Jitter()
+    jitter.image = image
+    jitter.blur_radius = sigma
+    jitter.noise_tolerance = noise_tolerance
+    return jitter.dejitter_full_image(box_size=box_size, **kwargs)
+
+@pytest.mark.parametrize('noise_tolerance', [1, 5, 20, 60, 200])
+@pytest.mark.parametrize('tile', [48, (30, 160)])
+def test_lattice(tile, noise_tolerance):
+    image = jittered_lattice()
+    np.testing.assert_array_equal(dejitter(image, noise_tolerance, tile=tile), dejitter(image, noise_tolerance))
+
+@pytest.mark.parametrize('noise_tolerance', [30, 60, 100])
+def test_ridge(noise_tolerance):
+    image = ridge()
+    np.testing.assert_array_equal(dejitter(image, noise_tolerance, sigma=1, tile=64),
+                                  dejitter(image, noise_tolerance, sigma=1))
+
+def test_subpixel_nearest_and_workers():
+    image = jittered_lattice(seed=1)
+    jitter = correct_jitter.Jitter(overlap='nearest')
+    jitter.image = image
+    jitter.blur_radius = 2
+    jitter.noise_tolerance = 60
+    expected = jitter.dejitter_full_image(box_size=10, subpixel=True)
+    np.testing.assert_array_equal(jitter.dejitter_tiled(box_size=10, tile=48, workers=2, subpixel=True), expected)
+
+def test_default_tile():
+    image = jittered_lattice()
+    jitter = correct_jitter.Jitter()
+    jitter.image = image
+    jitter.blur_radius = 2
+    jitter.noise_tolerance = 5
+    np.testing.assert_array_equal(jitter.dejitter_tiled(box_size=10, workers=None, tile=None), dejitter(image, 5))